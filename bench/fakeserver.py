@@ -0,0 +1,204 @@
+# coding: utf-8
+
+# ベンチマーク用のニコニコ動画の代替サーバー
+# ログイン、視聴ページ、flapi、getwaybackkey、マイリスト、api.json に応答する
+# コメントはスレッドとコメント番号から決定的に生成するため、大きなスレッドでもメモリを消費しない
+
+import sys, json, html, gzip, random, argparse, threading
+from time import sleep
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+# 2018-02-09 21:00 JST から 2018-02-26 21:00 JST
+START = 1518177600
+END = 1519646400
+
+_MASK = (1 << 64) - 1
+
+_CONTENTS = ('わこつ', 'ｗｗｗ', 'test,"quote"', '\U0001F600', 'ＭＭＤ杯', '8888')
+
+
+def mix(x):
+    x = (x + 0x9E3779B97F4A7C15) & _MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK
+    return x ^ (x >> 31)
+
+
+class Threads:
+    # 集計期間の前後3日を含む期間に、comments 件のコメントを per_second 件ずつ同じ秒にまとめて均等に配置する
+    def __init__(self, comments, per_second=1):
+        self.comments = comments
+        self._per_second = per_second
+        self._groups = (comments + per_second - 1) // per_second
+        self._first = START - 86400 * 3
+        self._span = END + 86400 * 3 - self._first
+
+    def date(self, no):
+        return self._first + self._span * ((no - 1) // self._per_second) // self._groups
+
+    def comment(self, thread, no):
+        h = mix(thread << 32 | no)
+        c = {'thread': str(thread), 'no': no, 'vpos': h % 60000, 'date': self.date(no), 'date_usec': 0}
+        if h >> 60 != 0:
+            if (h >> 56) & 1:
+                c['user_id'] = '%08x' % ((h >> 8) & 0xffffffff)
+                c['anonymity'] = 1
+            else:
+                users = max(1, self.comments // 5)
+                c['user_id'] = str(1 + mix(thread * 7 + (h >> 16) % users) % 10 ** 8)
+            if (h >> 52) % 10 < 3:
+                c['premium'] = 1
+        if (h >> 44) % 20 == 0:
+            c['deleted'] = 1
+        if (h >> 40) % 10 == 0:
+            c['score'] = -((h >> 20) % 5000 + 1)
+        if (h >> 36) % 10 < 3:
+            c['mail'] = '184'
+        c['content'] = _CONTENTS[(h >> 32) % len(_CONTENTS)]
+        return c
+
+    def page(self, thread, when, res_from):
+        # when より前に書き込まれた最新の -res_from 件を返す
+        lo, hi = 0, self.comments
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.date(mid) < when:
+                lo = mid
+            else:
+                hi = mid - 1
+        return [self.comment(thread, no) for no in range(max(1, lo + res_from + 1), lo + 1)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと短い本文を別々に書き込むため、Nagle アルゴリズムと遅延 ACK で応答が遅れないようにする
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def send(self, code, body, content_type='text/html', headers=(), counted=True):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        compress = body and 'gzip' in self.headers.get('Accept-Encoding', '') and not self.server.options.no_compress
+        if counted:
+            self.server.count('bytes', len(body))
+        if compress:
+            body = gzip.compress(body, 6)
+        if counted:
+            self.server.count('transfer_bytes', len(body))
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.route(b'')
+
+    def do_POST(self):
+        self.route(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def route(self, body):
+        options = self.server.options
+        url = urlsplit(self.path)
+        p = url.path
+        if p == '/__stats':
+            return self.send(200, json.dumps(self.server.stats), 'application/json', counted=False)
+        self.server.count('requests')
+        if options.latency:
+            sleep(options.latency / 1000)
+        if options.error_rate and p != '/secure/login' and random.random() < options.error_rate:
+            return self.send(503, 'service unavailable')
+        if p == '/secure/login':
+            return self.send(302, '', headers=(
+                ('Location', '/'),
+                ('Set-Cookie', 'user_session=user_session_1_bench; Path=/'),
+                ('Set-Cookie', 'user_session_secure=bench; Path=/'),
+            ))
+        if p == '/':
+            return self.send(200, '<html>top</html>')
+        if p.startswith('/watch/'):
+            num = int(p[len('/watch/sm'):])
+            data = {
+                'viewer': {'id': 1},
+                'thread': {'ids': {'default': str(num + 1000000)}},
+                'video': {'duration': 300, 'title': 'ベンチマーク動画 %d' % num},
+            }
+            return self.send(200, '<html><body>%s<div id="js-initial-watch-data" data-api-data="%s" '
+                                  'data-environment="{}"></div>%s</body></html>' % (
+                                      '<p>head</p>' * 2000, html.escape(json.dumps(data)), '<p>tail</p>' * 20000))
+        if p.startswith('/api/getflv/'):
+            num = int(p[len('/api/getflv/sm'):])
+            return self.send(200, 'thread_id=%d&l=300&user_id=1&url=x' % (num + 1000000), 'text/plain')
+        if p == '/api/getwaybackkey':
+            return self.send(200, 'waybackkey=%d.bench' % END, 'text/plain')
+        if p.startswith('/mylist/'):
+            mylist_id = int(p[len('/mylist/'):])
+            items = [{'item_type': 0, 'item_data': {
+                'video_id': 'sm%d' % (mylist_id * 100000 + i),
+                'title': 'ベンチマーク動画 %d' % (mylist_id * 100000 + i),
+                'view_counter': '0',
+                'num_res': str(options.comments),
+                'mylist_counter': '0',
+                'deleted': '0',
+            }} for i in range(options.videos)]
+            return self.send(200, '<html><script>\n    Mylist.preload(%d, %s);\n</script></html>' % (
+                mylist_id, json.dumps(items, ensure_ascii=False)))
+        if p.startswith('/api.json'):
+            thread = [row['thread'] for row in json.loads(body.decode('utf-8')) if 'thread' in row][0]
+            comments = self.server.threads.page(int(thread['thread']), thread['when'], thread['res_from'])
+            self.server.count('comments', len(comments))
+            rows = [{'thread': {'resultcode': 0, 'thread': thread['thread']}}]
+            rows += [{'chat': comment} for comment in comments]
+            return self.send(200, json.dumps(rows, ensure_ascii=False), 'application/json')
+        self.send(404, 'not found')
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, Handler)
+        self.options = options
+        self.threads = Threads(options.comments, options.per_second)
+        self.stats = {'requests': 0, 'connections': 0, 'comments': 0, 'bytes': 0, 'transfer_bytes': 0}
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # nicocc の終了時に keep-alive 接続が切断されるのは正常な動作
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='nicocc ベンチマーク用の代替サーバー')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--comments', type=int, default=10000, help='1スレッドあたりのコメント数')
+    parser.add_argument('--videos', type=int, default=12, help='1マイリストあたりの動画数')
+    parser.add_argument('--per-second', type=int, default=1, help='同じ秒に書き込まれるコメント数')
+    parser.add_argument('--latency', type=int, default=0, help='応答までの遅延(ミリ秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='503 を返す割合')
+    parser.add_argument('--no-compress', action='store_true', help='Accept-Encoding を無視して圧縮せずに応答する')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    server = Server(('127.0.0.1', options.port), options)
+    print('listening on 127.0.0.1:%d' % options.port, file=sys.stderr, flush=True)
+    server.serve_forever()
@@ -0,0 +1,179 @@
+# coding: utf-8
+
+# 代替サーバーに対して nicocc を実行し、スループットと処理時間を計測する
+#
+#   python bench/run.py --comments 100000 --videos 12 --mylists 2
+#
+# 子プロセスの最大メモリ使用量は resource モジュールが使える環境 (Linux, macOS) でのみ計測する
+
+import os, re, sys, json, glob, shutil, socket, argparse, tempfile, subprocess
+from time import sleep, monotonic
+from urllib.request import urlopen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NICOCC = os.path.join(os.path.dirname(BENCH_DIR), 'src', 'nicocc.py')
+
+_STAGE_REGEX = re.compile(r'処理時間 (.+): ([0-9.]+) 秒')
+
+_CONFIG = '''\
+[user]
+mail = "bench@example.com"
+password = "bench"
+
+[counter]
+start = "2018-02-09 21:00:00"
+end = "2018-02-26 21:00:00"
+mylist = [ %(mylists)s ]
+encoding = "utf-8"
+store = "%(store)s"
+unique = "%(unique)s"
+
+[http]
+interval = %(interval)d
+server_error_interval = %(server_error_interval)d
+retry = 4
+concurrency = %(concurrency)d
+
+[url]
+secure = "%(base)s"
+www = "%(base)s"
+flapi = "%(base)s"
+nmsg = "%(base)s"
+cookie_domain = "127.0.0.1"
+
+[logging]
+level = "INFO"
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_server(base, process):
+    for _ in range(100):
+        if process.poll() is not None:
+            sys.exit('代替サーバーの起動に失敗しました。')
+        try:
+            with urlopen(base + '/__stats') as res:
+                return json.loads(res.read().decode())
+        except OSError:
+            sleep(0.1)
+    sys.exit('代替サーバーに接続できません。')
+
+
+def read_stages(work_dir):
+    stages = []
+    for file in sorted(glob.glob(os.path.join(work_dir, 'log', '*.log'))):
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                m = _STAGE_REGEX.search(line)
+                if m:
+                    stages.append((m.group(1), float(m.group(2))))
+    return stages
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='nicocc のベンチマーク')
+    parser.add_argument('--comments', type=int, default=10000, help='1スレッドあたりのコメント数')
+    parser.add_argument('--videos', type=int, default=12, help='1マイリストあたりの動画数')
+    parser.add_argument('--mylists', type=int, default=2, help='マイリスト数')
+    parser.add_argument('--per-second', type=int, default=1, help='同じ秒に書き込まれるコメント数')
+    parser.add_argument('--latency', type=int, default=0, help='サーバーの応答遅延(ミリ秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='サーバーが 503 を返す割合')
+    parser.add_argument('--no-compress', action='store_true', help='サーバーが応答を圧縮しない')
+    parser.add_argument('--interval', type=int, default=0, help='http.interval (ミリ秒)')
+    parser.add_argument('--server-error-interval', type=int, default=100, help='http.server_error_interval (ミリ秒)')
+    parser.add_argument('--concurrency', type=int, default=1, help='http.concurrency')
+    parser.add_argument('--store', choices=('csv', 'binary'), default='csv', help='counter.store')
+    parser.add_argument('--unique', choices=('exact', 'hll'), default='exact', help='counter.unique')
+    parser.add_argument('--keep', action='store_true', help='作業フォルダを削除しない')
+    parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    port = free_port()
+    base = 'http://127.0.0.1:%d' % port
+    server = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'fakeserver.py'),
+        '--port', str(port),
+        '--comments', str(options.comments),
+        '--videos', str(options.videos),
+        '--per-second', str(options.per_second),
+        '--latency', str(options.latency),
+        '--error-rate', str(options.error_rate),
+    ] + (['--no-compress'] if options.no_compress else []))
+    work_dir = tempfile.mkdtemp(prefix='nicocc-bench-')
+    try:
+        wait_server(base, server)
+        with open(os.path.join(work_dir, 'nicocc.toml'), 'w', encoding='utf-8') as f:
+            f.write(_CONFIG % {
+                'mylists': ', '.join(str(i + 1) for i in range(options.mylists)),
+                'store': options.store,
+                'unique': options.unique,
+                'interval': options.interval,
+                'server_error_interval': options.server_error_interval,
+                'concurrency': options.concurrency,
+                'base': base,
+            })
+        env = dict(os.environ)
+        for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY'):
+            env.pop(name, None)
+        started = monotonic()
+        code = subprocess.call([sys.executable, NICOCC, work_dir], env=env, stdout=subprocess.DEVNULL)
+        elapsed = monotonic() - started
+        # 代替サーバーはまだ終了していないため、nicocc の最大メモリ使用量だけが計上される
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource else None
+        if peak_rss is not None and sys.platform != 'darwin':
+            peak_rss *= 1024
+        stats = wait_server(base, server)
+    finally:
+        server.terminate()
+        server.wait()
+    result = {
+        'exit_code': code,
+        'videos': options.videos * options.mylists,
+        'comments_per_thread': options.comments,
+        'elapsed': elapsed,
+        'requests': stats['requests'],
+        'requests_per_second': stats['requests'] / elapsed,
+        'comments': stats['comments'],
+        'comments_per_second': stats['comments'] / elapsed,
+        'response_bytes': stats['bytes'],
+        'transfer_bytes': stats['transfer_bytes'],
+        'peak_rss': peak_rss,
+        'stages': read_stages(work_dir),
+    }
+    if options.keep:
+        result['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if options.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print('終了コード         : %d' % result['exit_code'])
+        print('動画数             : %d (1動画あたり %d コメント)' % (result['videos'], result['comments_per_thread']))
+        print('処理時間           : %.3f 秒' % result['elapsed'])
+        print('リクエスト数       : %d (%.1f 件/秒)' % (result['requests'], result['requests_per_second']))
+        print('コメント数         : %d (%.1f 件/秒)' % (result['comments'], result['comments_per_second']))
+        print('応答本文           : %d バイト (転送 %d バイト)' % (result['response_bytes'], result['transfer_bytes']))
+        if peak_rss is not None:
+            print('最大メモリ使用量   : %.1f MiB' % (peak_rss / 1024 / 1024))
+        for name, seconds in result['stages']:
+            print('  %s: %.3f 秒' % (name, seconds))
+        if options.keep:
+            print('作業フォルダ       : %s' % work_dir)
+    sys.exit(1 if code else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# coding: utf-8
+
+# nicocc の起動時間と、コマンドごとに読み込まれる重いモジュールを計測する
+#
+#   python bench/startup.py --runs 20
+#   python bench/startup.py --check
+#
+# --check を指定すると、--version, --help, --show-config で読み込んではいけないモジュールが
+# 読み込まれていた場合に終了コード 1 で終了する
+
+import os, sys, json, argparse, subprocess
+from time import monotonic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(ROOT_DIR, 'src')
+NICOCC = os.path.join(SRC_DIR, 'nicocc.py')
+SAMPLE_DIR = os.path.join(ROOT_DIR, 'sample-20th')
+
+# 起動時間に影響する重いモジュール
+_HEAVY_MODULES = (
+    'toml',
+    'pytz',
+    'filelock',
+    'html.parser',
+    'http.client',
+    'http.cookiejar',
+    'urllib.request',
+    'concurrent.futures',
+    'multiprocessing',
+    'csv',
+    'resource',
+    'httpclient',
+    'proc',
+)
+
+# コマンドごとに読み込んではいけないモジュール
+_COMMANDS = (
+    ('--version', ['--version'], _HEAVY_MODULES),
+    ('--help', ['--help'], _HEAVY_MODULES),
+    ('--show-config', ['--show-config', SAMPLE_DIR], tuple(m for m in _HEAVY_MODULES if m not in ('toml', 'pytz'))),
+)
+
+# nicocc を実行した後に、読み込まれたモジュールを出力する
+_PROBE = '''\
+import sys, json, runpy
+sys.path.insert(0, %(src)r)
+sys.argv = %(argv)r
+try:
+    runpy.run_path(%(nicocc)r, run_name='__main__')
+except SystemExit:
+    pass
+sys.__stdout__.write('\\n' + json.dumps(sorted(sys.modules)) + '\\n')
+'''
+
+
+def measure(command, runs):
+    times = []
+    for _ in range(runs):
+        started = monotonic()
+        subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(monotonic() - started)
+    times.sort()
+    return times[len(times) // 2], times[0]
+
+
+def loaded_modules(args):
+    probe = _PROBE % {'src': SRC_DIR, 'argv': ['nicocc'] + args, 'nicocc': NICOCC}
+    output = subprocess.check_output([sys.executable, '-c', probe], stderr=subprocess.DEVNULL)
+    return set(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='nicocc の起動時間の計測')
+    parser.add_argument('--runs', type=int, default=10, help='コマンドごとの実行回数')
+    parser.add_argument('--check', action='store_true', help='読み込んではいけないモジュールがあれば失敗する')
+    parser.add_argument('--json', action='store_true', help='結果を JSON で出力する')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    interpreter, _ = measure([sys.executable, '-c', 'pass'], options.runs)
+    results = []
+    for name, args, forbidden in _COMMANDS:
+        median, best = measure([sys.executable, NICOCC] + args, options.runs)
+        modules = loaded_modules(args)
+        results.append({
+            'command': name,
+            'median': median,
+            'best': best,
+            'heavy_modules': sorted(m for m in _HEAVY_MODULES if m in modules),
+            'forbidden_modules': sorted(m for m in forbidden if m in modules),
+        })
+    if options.json:
+        print(json.dumps({'interpreter': interpreter, 'commands': results}, ensure_ascii=False, indent=2))
+    else:
+        print('Python の起動のみ   : %.3f 秒' % interpreter)
+        for result in results:
+            print('%-18s : 中央値 %.3f 秒, 最小 %.3f 秒' % (result['command'], result['median'], result['best']))
+            print('  読み込まれた重いモジュール: %s' % (', '.join(result['heavy_modules']) or 'なし'))
+            if result['forbidden_modules']:
+                print('  読み込んではいけないモジュール: %s' % ', '.join(result['forbidden_modules']))
+    if options.check and any(result['forbidden_modules'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 # coding: utf-8
 
-__all__ = ['parse_config']
+__all__ = ['parse_config', 'SCORE_STATS']
 
 import toml, re, sys
 from datetime import datetime
@@ -99,11 +99,43 @@ class UIntParser(IntParser):
             raise ParserError('設定ファイル "{}" のパラメータ "{}" は符号なし整数を記述してください。', file, self.key)
 
 
+class UFloatParser(TypeParser):
+    def __init__(self, **kwargs):
+        super().__init__((int, float), **kwargs)
+
+    def validate(self, value, file):
+        super().validate(value, file)
+        if value <= 0:
+            raise ParserError('設定ファイル "{}" のパラメータ "{}" は正の数を記述してください。', file, self.key)
+
+
+class FloatParser(TypeParser):
+    def __init__(self, **kwargs):
+        super().__init__((int, float), **kwargs)
+
+    def validate(self, value, file):
+        super().validate(value, file)
+        if isinstance(value, bool):
+            raise ParserError('設定ファイル "{}" のパラメータ "{}" は数値を記述してください。', file, self.key)
+
+
 class BoolParser(TypeParser):
     def __init__(self, **kwargs):
         super().__init__(bool, **kwargs)
 
 
+class ChoiceParser(StringParser):
+    def __init__(self, choices, **kwargs):
+        super().__init__(**kwargs)
+        self._choices = choices
+
+    def validate(self, value, file):
+        super().validate(value, file)
+        if value not in self._choices:
+            raise ParserError('設定ファイル "{}" のパラメータ "{}" は {} のいずれかを記述してください。', file, self.key,
+                              ', '.join('"%s"' % choice for choice in self._choices))
+
+
 class UIntListParser(TypeParser):
     def __init__(self, **kwargs):
         super().__init__(list, **kwargs)
@@ -117,6 +149,40 @@ class UIntListParser(TypeParser):
                 raise ParserError('設定ファイル "{}" のパラメータ "{}" は符号なし整数のリストを記述してください。', file, self.key)
 
 
+# result.csv の集計値の列に対応する評価値の重みの名前
+SCORE_STATS = (
+    'premium',
+    'premium_184',
+    'general',
+    'general_184',
+    'count_premium',
+    'count_premium_184',
+    'count_general',
+    'count_general_184',
+)
+
+
+class ScoreTermsParser(TypeParser):
+    # 追加の項 {stat = 集計値の名前, weight = 重み, power = 指数} のリストを (名前, 重み, 指数) のリストにする
+    def __init__(self, **kwargs):
+        super().__init__(list, **kwargs)
+
+    def validate(self, value, file):
+        super().validate(value, file)
+        for item in value:
+            if not isinstance(item, dict) or item.get('stat') not in SCORE_STATS:
+                raise ParserError('設定ファイル "{}" のパラメータ "{}" の stat は {} のいずれかを記述してください。', file, self.key,
+                                  ', '.join('"%s"' % stat for stat in SCORE_STATS))
+            for name in ('weight', 'power'):
+                if name in item and (not isinstance(item[name], (int, float)) or isinstance(item[name], bool)):
+                    raise ParserError('設定ファイル "{}" のパラメータ "{}" の {} は数値を記述してください。', file, self.key, name)
+            if item.get('power', 1) <= 0:
+                raise ParserError('設定ファイル "{}" のパラメータ "{}" の power は正の数を記述してください。', file, self.key)
+
+    def represent(self, value, file):
+        return [(item['stat'], item.get('weight', 1), item.get('power', 1)) for item in value]
+
+
 _DATETIME_REGEX = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})$')
 
 
@@ -152,6 +218,9 @@ _PARSER_MAP = (
     ('user', (
         ('mail', StringParser()),
         ('password', StringParser()),
+        ('save_session', BoolParser(
+            default_value=True,
+        )),
     )),
     ('counter', (
         ('start', DateParser()),
@@ -168,6 +237,27 @@ _PARSER_MAP = (
         ('encoding', StringParser(
             default_value='cp932',
         )),
+        ('verify_summary', BoolParser(
+            default_value=False,
+        )),
+        ('store', ChoiceParser(
+            ('csv', 'binary'),
+            default_value='csv',
+        )),
+        ('store_content', BoolParser(
+            default_value=True,
+        )),
+        ('unique', ChoiceParser(
+            ('exact', 'hll'),
+            default_value='exact',
+        )),
+        ('hll_error', UFloatParser(
+            default_value=0.01,
+        )),
+        ('deleted', ChoiceParser(
+            ('include', 'exclude'),
+            default_value='include',
+        )),
     )),
     ('http', (
         ('interval', UIntParser(
@@ -181,6 +271,108 @@ _PARSER_MAP = (
         ('retry', UIntParser(
             default_value=2,
         )),
+        ('timeout', UIntParser(
+            default_value=60,
+            represent_func=lambda _: _ / 1000 if _ > 0 else None,
+        )),
+        ('adaptive', BoolParser(
+            default_value=False,
+        )),
+        ('min_interval', UIntParser(
+            default_value=0.2,
+            represent_func=lambda _: _ / 1000,
+        )),
+        ('max_interval', UIntParser(
+            default_value=10,
+            represent_func=lambda _: _ / 1000,
+        )),
+        ('slow_response', UIntParser(
+            default_value=2,
+            represent_func=lambda _: _ / 1000,
+        )),
+        ('max_backoff', UIntParser(
+            default_value=300,
+            represent_func=lambda _: _ / 1000,
+        )),
+        ('concurrency', UIntParser(
+            default_value=1,
+            represent_func=lambda _: max(_, 1),
+        )),
+        ('compress', BoolParser(
+            default_value=True,
+        )),
+    )),
+    ('url', (
+        ('secure', StringParser(
+            default_value='https://secure.nicovideo.jp',
+            represent_func=lambda _: _.rstrip('/'),
+        )),
+        ('www', StringParser(
+            default_value='http://www.nicovideo.jp',
+            represent_func=lambda _: _.rstrip('/'),
+        )),
+        ('flapi', StringParser(
+            default_value='http://flapi.nicovideo.jp',
+            represent_func=lambda _: _.rstrip('/'),
+        )),
+        ('nmsg', StringParser(
+            default_value='http://nmsg.nicovideo.jp',
+            represent_func=lambda _: _.rstrip('/'),
+        )),
+        ('cookie_domain', StringParser(
+            default_value='.nicovideo.jp',
+        )),
+    )),
+    ('cache', (
+        ('video_info_ttl', UIntParser(
+            default_value=86400,
+        )),
+        ('waybackkey_ttl', UIntParser(
+            default_value=3600,
+        )),
+        ('comment_dir', StringParser(
+            default_value='',
+        )),
+    )),
+    ('analytics', (
+        ('enabled', BoolParser(
+            default_value=False,
+        )),
+        ('top', UIntParser(
+            default_value=100,
+        )),
+    )),
+    ('score', (
+        ('enabled', BoolParser(
+            default_value=True,
+        )),
+        ('premium', FloatParser(
+            default_value=1000,
+        )),
+        ('premium_184', FloatParser(
+            default_value=100,
+        )),
+        ('general', FloatParser(
+            default_value=10,
+        )),
+        ('general_184', FloatParser(
+            default_value=1,
+        )),
+        ('count_premium', FloatParser(
+            default_value=0,
+        )),
+        ('count_premium_184', FloatParser(
+            default_value=0,
+        )),
+        ('count_general', FloatParser(
+            default_value=0,
+        )),
+        ('count_general_184', FloatParser(
+            default_value=0,
+        )),
+        ('terms', ScoreTermsParser(
+            default_value=[],
+        )),
     )),
     ('logging', (
         ('level', StringParser(
@@ -196,7 +388,7 @@ for section, parsers in _PARSER_MAP:
     for name, parser in parsers:
         parser.set_key("%s.%s" % (section, name))
 
-def parse_config(config_file):
+def parse_config(config_file, optional_sections=()):
     try:
         with open(config_file, 'rb') as reader:
             bytes = reader.read()
@@ -215,9 +407,13 @@ def parse_config(config_file):
         if not isinstance(section_dict, dict):
             section_dict = {}
         for k, parser in parsers:
-            value = parser.parse(section_dict.get(k), config_file)
+            if name in optional_sections and section_dict.get(k) is None and parser.get_default() is None:
+                # 使用しないセクションは、記述がなければ None にする
+                value = None
+            else:
+                value = parser.parse(section_dict.get(k), config_file)
             setattr(getattr(config, name), k, value)
-            if parser.key == 'user.password':
+            if parser.key == 'user.password' and value is not None:
                 value = '*' * len(value)
             elif isinstance(value, datetime):
                 value = value.strftime('%Y-%m-%d %H:%M:%S')
@@ -7,26 +7,41 @@ __all__ = [
     'HttpClient',
 ]
 
-from http.cookiejar import CookieJar
+from http.cookiejar import CookieJar, Cookie
+from http.client import (
+    HTTPConnection,
+    HTTPSConnection,
+    BadStatusLine,
+)
 from urllib.request import (
     build_opener,
     Request,
     HTTPCookieProcessor,
+    HTTPHandler,
+    HTTPSHandler,
+)
+from urllib.error import (
+    URLError,
+    HTTPError,
 )
 from urllib.parse import (
     urlencode,
 )
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic, time
+from threading import Lock
+from random import uniform
+from socket import timeout as SocketTimeout
+from zlib import decompressobj, error as ZlibError, MAX_WBITS
 from logging import getLogger
 
-from resource import TZ
+from util import load_json, dump_json
 
 
 class RepresentError(Exception):
-    def __init__(self, *args, is_server_error=False):
+    def __init__(self, *args, is_server_error=False, is_auth_error=False):
         super().__init__(*args)
         self.is_server_error = is_server_error
+        self.is_auth_error = is_auth_error
 
 
 def represent_default(req, res):
@@ -40,69 +55,462 @@ def handle_error_default(req, err):
     raise err
 
 
+# セッションファイルに保存するクッキー
+_SESSION_COOKIES = ('user_session', 'user_session_secure')
+
+
+def is_timeout(err):
+    if isinstance(err, URLError) and not isinstance(err, HTTPError):
+        err = err.reason
+    return isinstance(err, (SocketTimeout, TimeoutError))
+
+
 logger = getLogger(__name__)
 
 
+class TokenBucket:
+    # interval 秒ごとに1トークンを補充するトークンバケット
+    # 全ワーカーで共有し、並列取得時も全体のリクエスト間隔を守る
+    def __init__(self, interval, capacity=1):
+        self._interval = interval
+        self._capacity = capacity
+        self._tat = None
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            tat = now if self._tat is None or self._tat < now else self._tat
+            delta = tat - (self._capacity - 1) * self._interval - now
+            self._tat = tat + self._interval
+        if delta > 0:
+            sleep(delta)
+            return delta
+        return 0
+
+    def delay(self, seconds):
+        with self._lock:
+            now = monotonic()
+            self._tat = (now if self._tat is None or self._tat < now else self._tat) + seconds
+
+    def set_interval(self, interval):
+        with self._lock:
+            self._interval = interval
+
+
+class AdaptivePacer:
+    # 応答が速く成功している間は間隔を少しずつ縮め(加算減少)、
+    # サーバーエラーやタイムアウトでは間隔を倍にして指数的に待機する(乗算増加)
+    def __init__(self, bucket, config):
+        self._bucket = bucket
+        self._adaptive = config.adaptive
+        self._interval = config.interval
+        self._min_interval = min(config.min_interval, config.interval)
+        self._max_interval = max(config.max_interval, config.interval)
+        self._step = max(config.interval / 10, 0.001)
+        self._slow_response = config.slow_response
+        self._server_error_interval = config.server_error_interval
+        self._max_backoff = max(config.max_backoff, config.server_error_interval)
+        self._failures = 0
+        self._lock = Lock()
+        self._started = None
+        self.requests = 0
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def _set_interval(self, interval):
+        if interval != self._interval:
+            logger.debug('リクエスト間隔を %.3f 秒から %.3f 秒に変更します。', self._interval, interval)
+            self._interval = interval
+            self._bucket.set_interval(interval)
+
+    def acquire(self):
+        waited = self._bucket.acquire()
+        with self._lock:
+            if self._started is None:
+                self._started = monotonic()
+            self.requests += 1
+        return waited
+
+    def success(self, elapsed):
+        if not self._adaptive:
+            return
+        with self._lock:
+            self._failures = 0
+            if elapsed < self._slow_response:
+                self._set_interval(max(self._min_interval, self._interval - self._step))
+
+    def failure(self, timed_out=False):
+        # 固定間隔の場合は、従来どおりタイムアウトでは待機せずに再試行する
+        if not self._adaptive:
+            if not timed_out:
+                self._bucket.delay(self._server_error_interval)
+            return
+        with self._lock:
+            self._failures += 1
+            self._set_interval(min(self._max_interval, self._interval * 2))
+            backoff = min(self._max_backoff, self._server_error_interval * 2 ** (self._failures - 1))
+            # 複数ワーカーの再試行が同時に集中しないよう、待機時間を揺らす
+            # 揺らしても server_error_interval より短くは待たない
+            backoff = uniform(max(self._server_error_interval, backoff / 2), backoff)
+        logger.info('サーバーの応答が不安定なため %.1f 秒待機します。', backoff)
+        self._bucket.delay(backoff)
+
+    def rate(self):
+        with self._lock:
+            if self._started is None or self.requests < 2:
+                return None
+            elapsed = monotonic() - self._started
+            return self.requests / elapsed if elapsed > 0 else None
+
+
+class ConnectionPool:
+    # (接続クラス, ホスト, トンネル先) ごとに keep-alive 接続を保持する
+    def __init__(self):
+        self._idle = {}
+        self._lock = Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def checkout(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            return connections.pop() if connections else None
+
+    def checkin(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def count(self, reused):
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.opened += 1
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+# Content-Encoding ごとの zlib のウィンドウサイズ
+_WBITS = {
+    'gzip': 16 + MAX_WBITS,
+    'x-gzip': 16 + MAX_WBITS,
+    'deflate': MAX_WBITS,
+}
+
+
+class PooledResponse:
+    # 本文を最後まで読み切った時点で接続をプールに返却する
+    # gzip, deflate で圧縮された本文は、読み込んだ分だけ逐次展開して返す
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = self.code = response.status
+        self.reason = self.msg = response.reason
+        self.headers = response.msg
+        self.url = url
+        self.encoding = (response.getheader('Content-Encoding') or '').strip().lower()
+        self._decoder = decompressobj(_WBITS[self.encoding]) if self.encoding in _WBITS else None
+        self._buffer = b''
+        self._deflate_head = b'' if self.encoding == 'deflate' else None
+        # bytes_read は展開後、raw_bytes_read は受信したままのバイト数
+        self.bytes_read = 0
+        self.raw_bytes_read = 0
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    @property
+    def remaining(self):
+        # 未受信の本文のバイト数 (Content-Length がない場合は None)
+        return self._response.length
+
+    def _read_raw(self, amt=None):
+        data = self._response.read() if amt is None else self._response.read(amt)
+        self.raw_bytes_read += len(data)
+        return data
+
+    def _decompress(self, data, max_length=0):
+        if self._deflate_head is None:
+            return self._decoder.decompress(data, max_length)
+        # zlib ヘッダーの有無が分かるまでは、受信した先頭部分を保持しておく
+        self._deflate_head += data
+        try:
+            decoded = self._decoder.decompress(data, max_length)
+        except ZlibError:
+            # zlib ヘッダーを付けずに deflate で圧縮された本文
+            self._decoder = decompressobj(-MAX_WBITS)
+            decoded = self._decoder.decompress(self._deflate_head, max_length)
+        if decoded or len(self._deflate_head) > 2:
+            self._deflate_head = None
+        return decoded
+
+    def _read_decoded(self, amt=None):
+        if amt is None:
+            data = self._buffer + self._decompress(self._decoder.unconsumed_tail + self._read_raw())
+            self._buffer = b''
+            return data + self._decoder.flush()
+        # 展開後の大きさを amt までに抑え、残りは unconsumed_tail として次回に展開する
+        data = self._buffer
+        while len(data) < amt:
+            chunk = self._decoder.unconsumed_tail or self._read_raw(amt)
+            if not chunk:
+                data += self._decoder.flush()
+                break
+            data += self._decompress(chunk, amt - len(data))
+        data, self._buffer = data[:amt], data[amt:]
+        return data
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            data = self._read_raw(amt)
+        else:
+            data = self._read_decoded(amt)
+        self.bytes_read += len(data)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._connection is None:
+            return
+        if self._response.isclosed():
+            self._release()
+        else:
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+    def _release(self):
+        if self._connection is not None:
+            self._pool.checkin(self._key, self._connection)
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _open_pooled(pool, http_class, req, **kwargs):
+    host = req.host
+    if not host:
+        raise URLError('no host given')
+    headers = dict(req.unredirected_hdrs)
+    headers.update({k: v for k, v in req.headers.items() if k not in headers})
+    headers = {name.title(): val for name, val in headers.items()}
+    tunnel_headers = {}
+    if req._tunnel_host and 'Proxy-Authorization' in headers:
+        tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+    key = (http_class.__name__, host, req._tunnel_host)
+    while True:
+        connection = pool.checkout(key)
+        if connection is None:
+            connection = http_class(host, timeout=req.timeout, **kwargs)
+            if req._tunnel_host:
+                connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        reused = connection.sock is not None
+        try:
+            try:
+                connection.request(req.get_method(), req.selector, req.data, headers)
+            except OSError as err:
+                if reused and isinstance(err, ConnectionError):
+                    raise
+                raise URLError(err)
+            response = connection.getresponse()
+        except (BadStatusLine, ConnectionError):
+            connection.close()
+            # サーバー側で切断済みの再利用接続は、新しい接続でやり直す
+            if reused:
+                continue
+            raise
+        except:
+            connection.close()
+            raise
+        pool.count(reused)
+        return PooledResponse(pool, key, connection, response, req.get_full_url())
+
+
+class PooledHTTPHandler(HTTPHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self._pool = pool
+
+    def http_open(self, req):
+        return _open_pooled(self._pool, HTTPConnection, req)
+
+
+class PooledHTTPSHandler(HTTPSHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self._pool = pool
+
+    def https_open(self, req):
+        return _open_pooled(self._pool, HTTPSConnection, req, context=self._context)
+
+
 class HttpClient:
     def __init__(self, r):
         self._r = r
-        self._lastaccess = None
+        self._bucket = TokenBucket(r.config.http.interval)
+        self._pacer = AdaptivePacer(self._bucket, r.config.http)
         self._cookiejar = CookieJar()
+        self._pool = ConnectionPool()
+        self._opener = build_opener(
+            PooledHTTPHandler(self._pool),
+            PooledHTTPSHandler(self._pool),
+            HTTPCookieProcessor(cookiejar=self._cookiejar),
+        )
+        self._opener_without_cookie = build_opener(
+            PooledHTTPHandler(self._pool),
+            PooledHTTPSHandler(self._pool),
+        )
+        self._received = [0, 0]
+        self._received_lock = Lock()
+        self.logins = 0
+
+    def close(self):
+        self._pool.close()
+        logger.info('HTTP接続数: 新規 %d 件, 再利用 %d 件', self._pool.opened, self._pool.reused)
+        rate = self._pacer.rate()
+        if rate is not None:
+            logger.info('HTTPリクエスト数: %d 件, 実効レート %.2f 件/秒, 最終リクエスト間隔 %.3f 秒',
+                        self._pacer.requests, rate, self._pacer.interval)
+        raw, decoded = self._received
+        if decoded > 0:
+            logger.info('HTTP受信量: 転送 %d バイト, 展開後 %d バイト (%.1f%%)', raw, decoded, raw * 100 / decoded)
+        logger.info('ログイン回数: %d 回', self.logins)
 
     def remove_user_session(self):
         try:
-            self._cookiejar.clear('.nicovideo.jp', '/', 'user_session')
+            self._cookiejar.clear(self._r.url.cookie_domain, '/', 'user_session')
         except KeyError:
             pass
         try:
-            self._cookiejar.clear('.nicovideo.jp', '/', 'user_session_secure')
+            self._cookiejar.clear(self._r.url.cookie_domain, '/', 'user_session_secure')
         except KeyError:
             pass
 
+    def save_session(self, file, owner):
+        cookies = [{
+            'name': cookie.name,
+            'value': cookie.value,
+            'domain': cookie.domain,
+            'path': cookie.path,
+            'secure': cookie.secure,
+            'expires': cookie.expires,
+        } for cookie in self._cookiejar if cookie.name in _SESSION_COOKIES]
+        dump_json(file, {'owner': owner, 'cookies': cookies}, mode=0o600)
+
+    def load_session(self, file, owner):
+        # 保存したアカウントと異なる場合や、期限切れのクッキーは使用しない
+        data = load_json(file)
+        if not isinstance(data, dict) or data.get('owner') != owner:
+            return False
+        now = time()
+        for c in data.get('cookies', []):
+            if c['expires'] is not None and c['expires'] <= now:
+                continue
+            self._cookiejar.set_cookie(Cookie(
+                0, c['name'], c['value'], None, False, c['domain'], True, c['domain'].startswith('.'),
+                c['path'], True, c['secure'], c['expires'], c['expires'] is None, None, None, {},
+            ))
+        return self.get_user_session() is not None and self.get_user_session_secure() is not None
+
     def get_user_session(self):
         for cookie in self._cookiejar:
-            if cookie.name == 'user_session' and cookie.path == '/' and cookie.domain == '.nicovideo.jp':
+            if cookie.name == 'user_session' and cookie.path == '/' and cookie.domain == self._r.url.cookie_domain:
                 return cookie.value
 
     def get_user_session_secure(self):
         for cookie in self._cookiejar:
-            if cookie.name == 'user_session_secure' and cookie.path == '/' and cookie.domain == '.nicovideo.jp':
+            if cookie.name == 'user_session_secure' and cookie.path == '/' and cookie.domain == self._r.url.cookie_domain:
                 return cookie.value
 
+    def _observe(self, endpoint, response, started, status=None):
+        elapsed = monotonic() - started
+        metrics = self._r.metrics
+        metrics.inc('http_requests_total', endpoint=endpoint, status=status or response.status)
+        metrics.observe('http_request_seconds', elapsed, endpoint=endpoint)
+        bytes_read = getattr(response, 'bytes_read', None)
+        if bytes_read is not None:
+            raw_bytes_read = response.raw_bytes_read
+            metrics.inc('http_response_bytes_total', bytes_read, endpoint=endpoint)
+            metrics.inc('http_transfer_bytes_total', raw_bytes_read, endpoint=endpoint)
+            metrics.observe('http_response_bytes', bytes_read, endpoint=endpoint)
+            with self._received_lock:
+                self._received[0] += raw_bytes_read
+                self._received[1] += bytes_read
+        return elapsed
+
     def request(self, url, data=None, method=None, headers=None, cookie=True, represent_func=None,
-                handle_error_func=None):
+                handle_error_func=None, endpoint='other'):
         headers = headers or {}
         headers['User-Agent'] = self._r.str.user_agent
+        if self._r.config.http.compress:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
         data = urlencode(data) if isinstance(data, dict) and 'Content-Type' not in headers else data
         if isinstance(data, str):
             data = data.encode()
         request = Request(url, data=data, headers=headers, method=method)
-        opener = build_opener(HTTPCookieProcessor(cookiejar=self._cookiejar)) if cookie else build_opener()
+        opener = self._opener if cookie else self._opener_without_cookie
+        metrics = self._r.metrics
         for i in range(self._r.config.http.retry + 1):
-            if self._lastaccess:
-                delta = self._lastaccess + self._r.config.http.interval - datetime.now(TZ).timestamp()
-                if delta > 0:
-                    sleep(delta)
+            if i > 0:
+                metrics.inc('http_retries_total', endpoint=endpoint)
+            metrics.observe('http_wait_seconds', self._pacer.acquire(), endpoint=endpoint)
             logger.debug('HTTPリクエスト %s - %s', request.get_method(), url)
+            # 再試行時は、ログインし直した後のクッキーを送る
+            request.remove_header('Cookie')
+            started = monotonic()
             try:
-                response = opener.open(request)
+                response = opener.open(request, timeout=self._r.config.http.timeout)
             except Exception as err:
+                if isinstance(err, HTTPError):
+                    err.close()
+                timed_out = is_timeout(err)
+                metrics.inc('http_requests_total', endpoint=endpoint, status=getattr(err, 'code', None) or
+                            ('timeout' if timed_out else 'error'))
+                metrics.observe('http_request_seconds', monotonic() - started, endpoint=endpoint)
                 try:
                     response = (handle_error_func if handle_error_func else handle_error_default)(request, err)
                 except Exception as err:
                     logger.warning(err)
-                    if hasattr(err, 'status') and (err.status // 100) == 5:
-                        sleep(self._r.config.http.server_error_interval)
+                    if timed_out or (hasattr(err, 'status') and (err.status // 100) == 5):
+                        self._pacer.failure(timed_out)
                     continue
                 return response
-            finally:
-                self._lastaccess = datetime.now(TZ).timestamp()
             try:
-                response = (represent_func if represent_func else represent_default)(request, response)
+                result = (represent_func if represent_func else represent_default)(request, response)
             except Exception as err:
+                response.close()
+                self._observe(endpoint, response, started, 'timeout' if is_timeout(err) else None)
                 logger.warning(err)
-                if isinstance(err, RepresentError) and err.is_server_error:
-                    sleep(self._r.config.http.server_error_interval)
+                if is_timeout(err) or (isinstance(err, RepresentError) and err.is_server_error):
+                    self._pacer.failure(is_timeout(err))
                 continue
-            return response
+            if result is not response:
+                response.close()
+            elapsed = self._observe(endpoint, response, started)
+            self._pacer.success(elapsed)
+            return result
         return None
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+__all__ = [
+    'MetadataCache',
+]
+
+import os
+from os import path
+from time import time
+from threading import Lock
+from logging import getLogger
+
+from util import load_json, dump_json, account_key
+
+logger = getLogger(__name__)
+
+
+class MetadataCache:
+    # 動画情報と waybackkey を作業フォルダ内のファイルに保存し、有効期限内は再利用する
+    # 変更はメモリ上にまとめておき、flush で一度に書き込む
+    def __init__(self, r):
+        self._r = r
+        self._file = r.path.metadata_cache
+        self._data = None
+        self._dirty = False
+        self._lock = Lock()
+
+    def _account(self):
+        return account_key(self._r.config.user.mail)
+
+    def _load(self):
+        if self._data is None:
+            data = load_json(self._file)
+            if not isinstance(data, dict) or data.get('account') != self._account():
+                data = {'account': self._account(), 'videos': {}, 'waybackkeys': {}}
+            self._data = data
+        return self._data
+
+    def _get(self, section, key, ttl):
+        if ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._load()[section].get(key)
+            if entry is None or entry['time'] + ttl < time():
+                return None
+            return entry['value']
+
+    def _set(self, section, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._load()[section][key] = {'time': time(), 'value': value}
+            self._dirty = True
+
+    def _remove(self, section, key):
+        with self._lock:
+            if self._load()[section].pop(key, None) is not None:
+                self._dirty = True
+
+    def get_video_info(self, video_id):
+        return self._get('videos', video_id, self._r.config.cache.video_info_ttl)
+
+    def set_video_info(self, video_id, value):
+        self._set('videos', video_id, value, self._r.config.cache.video_info_ttl)
+
+    def get_waybackkey(self, thread_id):
+        return self._get('waybackkeys', thread_id, self._r.config.cache.waybackkey_ttl)
+
+    def set_waybackkey(self, thread_id, value):
+        self._set('waybackkeys', thread_id, value, self._r.config.cache.waybackkey_ttl)
+
+    def remove_waybackkey(self, thread_id):
+        self._remove('waybackkeys', thread_id)
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                dump_json(self._file, self._data)
+                self._dirty = False
+
+    def clear(self):
+        with self._lock:
+            self._data = None
+            self._dirty = False
+            if path.isfile(self._file):
+                os.remove(self._file)
@@ -0,0 +1,133 @@
+# coding: utf-8
+
+__all__ = [
+    'Metrics',
+]
+
+import os
+from time import monotonic
+from threading import Lock
+from contextlib import contextmanager
+
+from util import dump_json
+
+# 秒単位のヒストグラムの上限値
+_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 名前ごとのヒストグラムの上限値 (指定のないものは秒単位)
+_BUCKETS = {
+    'comments_per_page': (0, 10, 100, 250, 500, 750, 1000),
+    'http_response_bytes': (1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+}
+
+_PREFIX = 'nicocc_'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = ('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items)
+    return '{%s}' % ','.join(escaped)
+
+
+class Metrics:
+    # 処理ごと、接続先ごとのカウンターとヒストグラムを集め、作業フォルダの終了時に書き出す
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(_BUCKETS.get(name, _SECONDS_BUCKETS))
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = monotonic()
+        yield
+        self.observe(name, monotonic() - started, **labels)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'counters': [{
+                    'name': name,
+                    'labels': dict(labels),
+                    'value': value,
+                } for (name, labels), value in sorted(self._counters.items())],
+                'histograms': [{
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'min': histogram.min,
+                    'max': histogram.max,
+                    'buckets': [[bound, count] for bound, count in histogram.cumulative()],
+                } for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s%s counter' % (_PREFIX, name))
+                lines.append('%s%s%s %s' % (_PREFIX, name, _format_labels(labels), value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s%s histogram' % (_PREFIX, name))
+                for bound, count in histogram.cumulative():
+                    lines.append('%s%s_bucket%s %d' % (_PREFIX, name, _format_labels(labels, (('le', str(bound)),)), count))
+                lines.append('%s%s_bucket%s %d' % (_PREFIX, name, _format_labels(labels, (('le', '+Inf'),)), histogram.count))
+                lines.append('%s%s_sum%s %s' % (_PREFIX, name, _format_labels(labels), histogram.sum))
+                lines.append('%s%s_count%s %d' % (_PREFIX, name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file, prometheus_file):
+        dump_json(json_file, self.to_dict())
+        with open(prometheus_file + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(prometheus_file + '.tmp', prometheus_file)
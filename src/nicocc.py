@@ -1,22 +1,142 @@
 # coding: utf-8
 
-__version__ = '0.2.6'
-
 import sys
 
 if sys.version_info.major < 3:
     print >> sys.stderr, u'nicocc は Python 2.x.x には対応していません。'
     sys.exit(1)
 
-from os import path
-from logging import getLogger
+from version import __version__, HELP
 
-from util import *
-from resource import *
-from proc import *
+# --version, --help, --show-config を速く表示できるよう、
+# 各処理に必要なモジュールはその処理の中で読み込む
+
+
+def process(arg, shared_dir=None, parallel=False, offline=False):
+    from os import path
+    from logging import getLogger
+    from util import puts, measure, set_output_prefix
+    from resource import Resource
+    from proc import generate_videos_csv, generate_result_csv, generate_analytics_csv, reaggregate_result_csv
+
+    logger = getLogger(__name__)
+    if parallel:
+        set_output_prefix(path.basename(path.normpath(arg)))
+    with Resource(arg, shared_dir, offline) as r:
+        puts('%s の処理を開始します。' % arg, logger)
+        if parallel:
+            logger.info('設定値\n%s', r.config)
+        else:
+            print(r.config, end='')
+        if offline:
+            # 並列処理の子プロセスからは、さらにプロセスを起動しない
+            with measure('再集計', logger, r.metrics):
+                reaggregate_result_csv(r, 1 if parallel else None)
+        else:
+            changed_videos = None
+            if r.config.counter.overwrite_videos or not path.isfile(r.path.videos_csv):
+                with measure('動画リスト', logger, r.metrics):
+                    changed_videos = generate_videos_csv(r)
+            generate_result_csv(r, changed_videos)
+        if r.config.analytics.enabled:
+            with measure('動画横断集計', logger, r.metrics):
+                generate_analytics_csv(r)
+        puts('%s の処理を正常に終了しました。' % arg, logger)
+
+
+def process_parallel(args, jobs, shared_dir, offline=False):
+    from logging import getLogger
+    from concurrent.futures import ProcessPoolExecutor, as_completed
 
-if __name__ == '__main__':
     logger = getLogger(__name__)
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process, arg, shared_dir, True, offline): arg for arg in args}
+        for i, future in enumerate(as_completed(futures)):
+            arg = futures[future]
+            try:
+                future.result()
+            except BaseException as err:
+                failed.append(arg)
+                logger.debug('%s - %s', arg, err)
+                print('%s の処理に失敗しました。 (%d / %d)' % (arg, i + 1, len(args)), file=sys.stderr)
+            else:
+                print('%s の処理が完了しました。 (%d / %d)' % (arg, i + 1, len(args)))
+    return failed
+
+
+def show_config(args):
+    from os import path
+    from config import parse_config
+
+    for arg in args:
+        print('%s の設定値' % arg)
+        print(parse_config(path.join(arg, 'nicocc.toml')))
+
+
+def clear_cache(args):
+    from logging import getLogger
+    from util import puts
+    from resource import Resource
+
+    logger = getLogger(__name__)
+    for arg in args:
+        with Resource(arg) as r:
+            r.metadata.clear()
+            puts('%s の動画情報キャッシュを削除しました。' % arg, logger)
+
+
+def export_csv(args):
+    from logging import getLogger
+    from util import puts
+    from resource import Resource
+    from proc import export_comment_csv
+
+    logger = getLogger(__name__)
+    for arg in args:
+        with Resource(arg, offline=True) as r:
+            puts('%s のコメントファイルを CSV ファイルに書き出します。' % arg, logger)
+            export_comment_csv(r)
+
+
+def run(args):
+    import shutil, tempfile
+
+    jobs = 1
+    offline = False
+    while args and args[0] in ('--jobs', '-j', '--offline', '--reaggregate'):
+        if args[0] in ('--offline', '--reaggregate'):
+            offline = True
+            args = args[1:]
+            continue
+        if len(args) < 3 or not args[1].isdigit() or int(args[1]) < 1:
+            print(HELP, file=sys.stderr)
+            sys.exit(1)
+        jobs = int(args[1])
+        args = args[2:]
+    if not args:
+        print(HELP, file=sys.stderr)
+        sys.exit(1)
+    # 複数の作業フォルダで同じ動画を指定した場合は、一度取得したコメントを共有する
+    shared_dir = tempfile.mkdtemp(prefix='nicocc-') if len(args) > 1 and not offline else None
+    try:
+        if jobs > 1 and len(args) > 1:
+            failed = process_parallel(args, jobs, shared_dir, offline)
+            if failed:
+                print('処理に失敗した作業フォルダ: %s' % ', '.join(failed), file=sys.stderr)
+                sys.exit(1)
+        else:
+            for arg in args:
+                process(arg, shared_dir, offline=offline)
+    finally:
+        if shared_dir:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+
+def main():
+    if getattr(sys, 'frozen', False):
+        from multiprocessing import freeze_support
+        freeze_support()
 
     if len(sys.argv) < 2 or sys.argv[1] in ('--help','-h',):
         print(HELP, file=sys.stderr)
@@ -25,15 +145,16 @@ if __name__ == '__main__':
         print('nicocc v%s' % __version__, file=sys.stderr)
         sys.exit(1)
     if sys.argv[1] in ('--show-config','-c',):
-        for arg in sys.argv[2:]:
-            print('%s の設定値' % arg)
-            print(Resource(arg).config)
+        show_config(sys.argv[2:])
         sys.exit(1)
-    for arg in sys.argv[1:]:
-        with Resource(arg) as r:
-            puts('%s の処理を開始します。' % arg, logger)
-            print(r.config, end='')
-            if r.config.counter.overwrite_videos or not path.isfile(r.path.videos_csv):
-                generate_videos_csv(r)
-            generate_result_csv(r)
-            puts('%s の処理を正常に終了しました。' % arg, logger)
+    if sys.argv[1] in ('--clear-cache',):
+        clear_cache(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1] in ('--export-csv',):
+        export_csv(sys.argv[2:])
+        sys.exit(0)
+    run(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,3 +2,5 @@
 
 from .comments import generate_result_csv
 from .videos import generate_videos_csv
+from .analytics import generate_analytics_csv
+from .offline import reaggregate_result_csv, export_comment_csv
@@ -0,0 +1,220 @@
+# coding: utf-8
+
+__all__ = [
+    'CommentSummary',
+    'new_comment_summary',
+    'restore_comment_summary',
+    'load_comment_summary',
+    'summarize_comment_store',
+    'write_result_csv',
+]
+
+import csv, os, shutil
+from os import path
+from logging import getLogger
+
+from util import *
+from .store import open_comment_store
+from .score import (
+    compute_scores,
+    rank_scores,
+    format_score,
+)
+from .distinct import (
+    create_counter,
+    load_counter,
+)
+
+logger = getLogger(__name__)
+
+_RESULT_CSV_HEADER = (
+    '動画ID',
+    '動画タイトル',
+    'プレミアム会員ユニークコメント数',
+    '匿名プレミアム会員ユニークコメント数',
+    '一般会員ユニークコメント数',
+    '匿名一般会員ユニークコメント数',
+    'プレミアム会員コメント数',
+    '匿名プレミアム会員コメント数',
+    '一般会員コメント数',
+    '匿名一般会員コメント数',
+)
+
+_SCORE_CSV_HEADER = (
+    '評価値',
+    '順位',
+)
+
+_KEYS = (
+    'premium',
+    'premium_184',
+    'general',
+    'general_184',
+)
+
+
+class CommentSummary:
+    # コメントを受け取るたびにユニークコメント数とコメント数を更新する
+    def __init__(self, mode='exact', error=None, deleted='include'):
+        self.title = None
+        self.deleted = deleted
+        self.unique = {key: create_counter(mode, error) for key in _KEYS}
+        self.count = {key: 0 for key in _KEYS}
+
+    @property
+    def kind(self):
+        return self.unique[_KEYS[0]].kind
+
+    @property
+    def error(self):
+        return self.unique[_KEYS[0]].error
+
+    def add(self, title, user_id, premium, anonymity, deleted=0):
+        if self.title is None:
+            self.title = title
+        if user_id == '' or (deleted == 1 and self.deleted == 'exclude'):
+            return
+        key = ('premium' if premium == 1 else 'general') + ('_184' if anonymity == 1 else '')
+        self.unique[key].add(user_id)
+        self.count[key] += 1
+
+    def add_comment(self, title, comment):
+        self.add(
+            title,
+            str(comment.get('user_id', '')),
+            1 if str(comment.get('premium', 0)) == '1' else 0,
+            1 if str(comment.get('anonymity', 0)) == '1' else 0,
+            1 if str(comment.get('deleted', 0)) == '1' else 0,
+        )
+
+    def row(self):
+        return tuple(len(self.unique[key]) for key in _KEYS) + tuple(self.count[key] for key in _KEYS)
+
+    def to_dict(self):
+        d = {'title': self.title, 'deleted': self.deleted}
+        for key in _KEYS:
+            d['unique_' + key] = self.unique[key].to_data()
+            d['count_' + key] = self.count[key]
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls(deleted=d.get('deleted', 'include'))
+        summary.title = d['title']
+        for key in _KEYS:
+            summary.unique[key] = load_counter(d['unique_' + key])
+            summary.count[key] = d['count_' + key]
+        return summary
+
+
+def new_comment_summary(r):
+    return CommentSummary(r.config.counter.unique, r.config.counter.hll_error, r.config.counter.deleted)
+
+
+def restore_comment_summary(r, d):
+    # 設定と異なる方式で保存されたサマリーは使用しない
+    try:
+        summary = CommentSummary.from_dict(d) if d else None
+    except (KeyError, TypeError, ValueError):
+        return None
+    expected = new_comment_summary(r)
+    if summary is None or summary.kind != expected.kind or summary.deleted != expected.deleted:
+        return None
+    return summary
+
+
+def load_comment_summary(r, video_id):
+    if r.incomplete_cache:
+        state = load_json(r.path.get_comment_state(video_id))
+        d = state.get('summary') if state else None
+    else:
+        d = load_json(r.path.get_comment_summary(video_id))
+    summary = restore_comment_summary(r, d)
+    if d and summary is None:
+        logger.debug('%s の集計サマリーは使用できません。', video_id)
+    return summary
+
+
+def summarize_comment_store(r, store, complete):
+    summary = new_comment_summary(r)
+    for title, user_id, premium, anonymity, deleted in store.iter_fields(complete):
+        summary.add(title, user_id, premium, anonymity, deleted)
+    return summary
+
+
+def get_video_summary(r, video_id):
+    store = open_comment_store(r, video_id)
+    complete = not r.incomplete_cache
+    if not store.exists(complete):
+        return new_comment_summary(r)
+    summary = load_comment_summary(r, video_id)
+    if summary is not None and not r.config.counter.verify_summary:
+        return summary
+    parsed = summarize_comment_store(r, store, complete)
+    if summary is None:
+        logger.debug('%s の集計サマリーがないため、コメントファイルから集計します。', video_id)
+    elif summary.row() != parsed.row():
+        logger.warning('%s の集計サマリーがコメントファイルと一致しません。 - %s != %s', video_id, summary.row(), parsed.row())
+    return parsed
+
+
+def write_result_csv(r, videos, rows=None):
+    # rows には動画IDごとに集計済みの (タイトル, 集計値) を渡せる
+    result_csv = r.path.get_result_csv(r.incomplete_cache)
+    result_temp_csv = r.path.result_temp_csv
+    results = []
+    for video_id, video_title in videos.items():
+        if rows is None:
+            summary = get_video_summary(r, video_id)
+            title, counts = summary.title, summary.row()
+        else:
+            title, counts = rows[video_id]
+        results.append((video_id, video_title or title or '', counts))
+    score = r.config.score.enabled
+    if score:
+        scores = compute_scores(r.config.score, [counts for _, _, counts in results])
+        order, ranks = rank_scores(scores)
+    # HyperLogLog の場合は、ユニークコメント数の相対標準誤差を列に追加する
+    error = new_comment_summary(r).error if r.config.counter.unique == 'hll' else None
+    with open(result_temp_csv, mode='w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        header = _RESULT_CSV_HEADER
+        if error is not None:
+            header += ('ユニークコメント数の推定誤差',)
+        if score:
+            header += _SCORE_CSV_HEADER
+        writer.writerow(header)
+        for i, (video_id, title, counts) in enumerate(results):
+            try:
+                row = (video_id, title) + counts
+                if error is not None:
+                    row += ('%.4f' % error,)
+                if score:
+                    row += (format_score(scores[i]), ranks[i])
+                writer.writerow(row)
+            except Exception as err:
+                abort(err, logger)
+    if path.isfile(result_csv):
+        os.remove(result_csv)
+    shutil.move(result_temp_csv, result_csv)
+    puts('集計結果を %s に出力しました。' % result_csv, logger)
+    if score:
+        write_ranking_csv(r, results, scores, order, ranks)
+
+
+def write_ranking_csv(r, results, scores, order, ranks):
+    # 評価値の降順に並べた順位表を出力する
+    ranking_csv = r.path.get_ranking_csv(r.incomplete_cache)
+    ranking_temp_csv = path.join(r.path.temp_dir, '_' + path.basename(ranking_csv))
+    with open(ranking_temp_csv, mode='w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(_SCORE_CSV_HEADER[::-1] + _RESULT_CSV_HEADER)
+        try:
+            writer.writerows((ranks[i], format_score(scores[i]), results[i][0], results[i][1]) + results[i][2]
+                             for i in order)
+        except Exception as err:
+            abort(err, logger)
+    if path.isfile(ranking_csv):
+        os.remove(ranking_csv)
+    shutil.move(ranking_temp_csv, ranking_csv)
+    puts('順位表を %s に出力しました。' % ranking_csv, logger)
@@ -0,0 +1,150 @@
+# coding: utf-8
+
+__all__ = ['generate_analytics_csv']
+
+import csv, os, shutil, heapq
+from os import path
+from collections import Counter
+from logging import getLogger
+
+from util import *
+from .comments import load_videos
+from .store import open_comment_store
+from .distinct import user_key
+
+logger = getLogger(__name__)
+
+_CATEGORIES = (
+    ('premium', 'プレミアム会員'),
+    ('premium_184', '匿名プレミアム会員'),
+    ('general', '一般会員'),
+    ('general_184', '匿名一般会員'),
+)
+
+_CATEGORY_BITS = {name: 1 << i for i, (name, _) in enumerate(_CATEGORIES)}
+
+
+class UserIndex:
+    # ユーザーごとに [コメントした動画のビットマスク, コメント数, 区分のビットマスク, 匿名ID] を保持する
+    # 数値の会員IDは整数のキーから復元できるため、文字列は保持しない
+    def __init__(self):
+        self._users = {}
+
+    def add(self, video_index, user_id, premium, anonymity):
+        key = user_key(user_id)
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [0, 0, 0, None if key < (1 << 63) else user_id]
+        entry[0] |= 1 << video_index
+        entry[1] += 1
+        entry[2] |= _CATEGORY_BITS[('premium' if premium == 1 else 'general') + ('_184' if anonymity == 1 else '')]
+
+    def __len__(self):
+        return len(self._users)
+
+    def category_count(self, name):
+        bit = _CATEGORY_BITS[name]
+        return sum(1 for entry in self._users.values() if entry[2] & bit)
+
+    def repeat_count(self):
+        return sum(1 for entry in self._users.values() if entry[0] & (entry[0] - 1))
+
+    def overlaps(self):
+        overlaps = Counter()
+        for entry in self._users.values():
+            mask = entry[0]
+            if not mask & (mask - 1):
+                continue
+            indexes = video_indexes(mask)
+            for i, a in enumerate(indexes):
+                for b in indexes[i + 1:]:
+                    overlaps[(a, b)] += 1
+        return overlaps
+
+    def top(self, n):
+        items = heapq.nsmallest(
+            n,
+            self._users.items(),
+            key=lambda item: (-bin(item[1][0]).count('1'), -item[1][1], item[0]),
+        )
+        for key, (mask, count, _, user_id) in items:
+            yield user_id if user_id is not None else str(key), mask, count
+
+
+def video_indexes(mask):
+    indexes = []
+    i = 0
+    while mask:
+        if mask & 1:
+            indexes.append(i)
+        mask >>= 1
+        i += 1
+    return indexes
+
+
+def write_csv(r, file, header, rows):
+    temp_file = path.join(r.path.temp_dir, '_' + path.basename(file))
+    with open(temp_file, mode='w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        try:
+            writer.writerows(rows)
+        except Exception as err:
+            abort(err, logger)
+    if path.isfile(file):
+        os.remove(file)
+    shutil.move(temp_file, file)
+    puts('集計結果を %s に出力しました。' % file, logger)
+
+
+def generate_analytics_csv(r):
+    videos = load_videos(r)
+    video_ids = list(videos.keys())
+    complete = not r.incomplete_cache
+    index = UserIndex()
+    comment_count = 0
+    exclude_deleted = r.config.counter.deleted == 'exclude'
+    for i, video_id in enumerate(video_ids):
+        store = open_comment_store(r, video_id)
+        if not store.exists(complete):
+            logger.debug('%s のコメントがないため、動画横断集計から除外します。', video_id)
+            continue
+        for _, user_id, premium, anonymity, deleted in store.iter_fields(complete):
+            if user_id == '' or (deleted == 1 and exclude_deleted):
+                continue
+            index.add(i, user_id, premium, anonymity)
+            comment_count += 1
+    logger.debug('%d 件のコメントから %d 人のユーザーを集計しました。', comment_count, len(index))
+
+    summary_rows = [('動画数', len(video_ids)), ('コメント数', comment_count), ('ユニークユーザー数', len(index))]
+    for name, label in _CATEGORIES:
+        summary_rows.append(('%sユニークユーザー数' % label, index.category_count(name)))
+    summary_rows.append(('複数の動画にコメントしたユーザー数', index.repeat_count()))
+    write_csv(r, r.path.get_analytics_csv('contest_summary', r.incomplete_cache), ('項目', '値'), summary_rows)
+
+    overlaps = index.overlaps()
+    write_csv(r, r.path.get_analytics_csv('overlap', r.incomplete_cache), (
+        '動画ID',
+        '動画タイトル',
+        '動画ID',
+        '動画タイトル',
+        '共通ユーザー数',
+    ), ((
+        video_ids[a],
+        videos[video_ids[a]],
+        video_ids[b],
+        videos[video_ids[b]],
+        count,
+    ) for (a, b), count in sorted(overlaps.items())))
+
+    write_csv(r, r.path.get_analytics_csv('top_commenters', r.incomplete_cache), (
+        'ユーザーID',
+        'コメントした動画数',
+        'コメント数',
+        '動画ID',
+    ), ((
+        user_id,
+        bin(mask).count('1'),
+        count,
+        ' '.join(video_ids[i] for i in video_indexes(mask)),
+    ) for user_id, mask, count in index.top(r.config.analytics.top)))
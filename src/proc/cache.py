@@ -0,0 +1,152 @@
+# coding: utf-8
+
+__all__ = ['CommentCache']
+
+import os, json, tempfile
+from os import path
+from time import time
+from logging import getLogger
+
+from filelock import FileLock
+
+from util import *
+
+logger = getLogger(__name__)
+
+# キャッシュから読み込んだコメントをコメントファイルに書き込む単位
+_PAGE_SIZE = 1000
+
+
+class CommentCache:
+    # 作業フォルダやバージョン、文字コードをまたいで、動画ごとの取得済みコメントを保存する
+    # meta.json には取得済みの期間 (書き込み日時の範囲) を、comments.jsonl にはコメント番号の降順でコメントを保存する
+    def __init__(self, r, video_id):
+        self.video_id = video_id
+        self._dir = path.join(r.path.comment_cache_dir, video_id)
+        self._meta_file = path.join(self._dir, 'meta.json')
+        self._comments_file = path.join(self._dir, 'comments.jsonl')
+        self._lock = FileLock(path.join(r.path.comment_cache_dir, '%s.lock' % video_id))
+        self._start = int(r.config.counter.start.timestamp())
+        self._end = int(r.config.counter.end.timestamp())
+        self._out = None
+        self._temp_file = None
+        self._title = None
+        self._attr = None
+        self._fetched_at = None
+
+    def _load_meta(self):
+        meta = load_json(self._meta_file)
+        if not isinstance(meta, dict) or not path.isfile(self._comments_file):
+            return None
+        return meta
+
+    def covers(self):
+        with self._lock:
+            meta = self._load_meta()
+        if not meta:
+            return False
+        return any(start <= self._start and self._end <= end for start, end in meta['coverage'])
+
+    def read(self):
+        # 集計期間内のコメントを、ページ単位でコメント番号の降順に返す
+        # ファイル全体は読み込まず、1行ずつ読みながら返すため、読み終えるまでロックを保持する
+        with self._lock:
+            meta = self._load_meta()
+            with open(self._comments_file, 'r', encoding='utf-8') as f:
+                yield meta['title'], meta['attr']
+                page = []
+                for line in f:
+                    comment = json.loads(line)
+                    if self._start <= comment['date'] <= self._end:
+                        page.append(comment)
+                        if len(page) >= _PAGE_SIZE:
+                            yield page
+                            page = []
+                if page:
+                    yield page
+
+    def begin(self, title, attr):
+        if not path.isdir(self._dir):
+            os.makedirs(self._dir, exist_ok=True)
+        fd, self._temp_file = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+        self._out = open(fd, 'w', encoding='utf-8')
+        self._title = title
+        self._attr = attr
+        # 取得開始時点までに書き込まれたコメントは、すべて取得できる
+        self._fetched_at = int(time())
+
+    def write(self, comments):
+        if self._out:
+            for comment in comments:
+                self._out.write(json.dumps(comment, ensure_ascii=False) + '\n')
+
+    def commit(self):
+        if not self._out:
+            return
+        self._out.close()
+        self._out = None
+        coverage = [self._start, min(self._end, self._fetched_at)]
+        with self._lock:
+            meta = self._load_meta() or {'coverage': []}
+            fd, merged_file = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+            try:
+                with open(fd, 'w', encoding='utf-8') as out:
+                    count = merge_comment_files(
+                        self._temp_file, self._comments_file if meta['coverage'] else None, out)
+                os.replace(merged_file, self._comments_file)
+            except BaseException:
+                os.remove(merged_file)
+                raise
+            os.remove(self._temp_file)
+            self._temp_file = None
+            dump_json(self._meta_file, {
+                'title': self._title,
+                'attr': self._attr,
+                'coverage': merge_coverage(meta['coverage'] + [coverage]),
+            })
+        logger.debug('%s のコメント %d 件をコメントキャッシュに保存しました。', self.video_id, count)
+
+    def discard(self):
+        if self._out:
+            self._out.close()
+            self._out = None
+        if self._temp_file and path.isfile(self._temp_file):
+            os.remove(self._temp_file)
+        self._temp_file = None
+
+
+def _iter_lines(file):
+    if file is None:
+        return
+    with open(file, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)['no'], line
+
+
+def merge_comment_files(new_file, old_file, out):
+    # どちらのファイルもコメント番号の降順のため、1行ずつ比較しながら結合する
+    # 同じコメント番号の場合は、新しく取得したコメントを残す
+    new_lines, old_lines = _iter_lines(new_file), _iter_lines(old_file)
+    new, old = next(new_lines, None), next(old_lines, None)
+    count = 0
+    while new is not None or old is not None:
+        if old is None or (new is not None and new[0] >= old[0]):
+            if old is not None and new[0] == old[0]:
+                old = next(old_lines, None)
+            out.write(new[1])
+            new = next(new_lines, None)
+        else:
+            out.write(old[1])
+            old = next(old_lines, None)
+        count += 1
+    return count
+
+
+def merge_coverage(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
@@ -2,19 +2,27 @@
 
 __all__ = ['generate_result_csv']
 
-import csv, re, json, shutil, os
-from os import path
-from datetime import datetime
+import csv, re, json, os, sys, html
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
 from logging import getLogger
 from html.parser import HTMLParser
 from urllib.parse import (
     parse_qs,
 )
-from time import sleep
 
 from httpclient import *
 from util import *
+from .aggregate import (
+    new_comment_summary,
+    restore_comment_summary,
+    summarize_comment_store,
+    write_result_csv,
+)
+from .store import open_comment_store
+from .shared import SharedComments
+from .cache import CommentCache
 
 logger = getLogger(__name__)
 
@@ -41,18 +49,51 @@ def load_videos(r):
     return videos
 
 
+_login_lock = RLock()
+
+
+def _session_owner(r):
+    return account_key(r.config.user.mail)
+
+
 def login(r):
-    r.client.remove_user_session()
-    response = r.client.request(
-        r.url.login_url,
-        data={
-            'mail': r.config.user.mail,
-            'password': r.config.user.password,
-        },
-    )
-    if not response or not r.client.get_user_session() or not r.client.get_user_session_secure():
-        abort('ログインに失敗しました。', logger)
-    logger.debug('ログインに成功しました。')
+    with _login_lock:
+        r.client.remove_user_session()
+        response = r.client.request(
+            r.url.login_url,
+            data={
+                'mail': r.config.user.mail,
+                'password': r.config.user.password,
+            },
+            endpoint='login',
+        )
+        if response:
+            # リダイレクト先のトップページは読まないため、接続を残さないよう閉じる
+            response.close()
+        if not response or not r.client.get_user_session() or not r.client.get_user_session_secure():
+            abort('ログインに失敗しました。', logger)
+        r.client.logins += 1
+        r.metrics.inc('logins_total')
+        logger.debug('ログインに成功しました。')
+        if r.config.user.save_session:
+            r.client.save_session(r.path.session, _session_owner(r))
+
+
+def restore_session(r):
+    if r.config.user.save_session and r.client.load_session(r.path.session, _session_owner(r)):
+        logger.debug('保存済みのセッションを使用します。')
+        return
+    login(r)
+
+
+def relogin(r, req):
+    with _login_lock:
+        # 他のスレッドが既にログインし直している場合は、新しいセッションで再試行する
+        session = r.client.get_user_session()
+        if session and 'user_session=%s' % session not in (req.get_header('Cookie') or ''):
+            return
+        logger.info('セッションが無効になったため、ログインし直します。')
+        login(r)
 
 
 class VideoInfoParser(HTMLParser):
@@ -70,7 +111,96 @@ class VideoInfoParser(HTMLParser):
                             return
 
 
+_WATCH_DATA_MARKER = b'id="js-initial-watch-data"'
+_API_DATA_ATTR = b'data-api-data="'
+# 視聴ページの未受信の部分 (転送されるままのバイト数) がこの大きさまでなら読み切って、接続を再利用できるようにする
+_DRAIN_LIMIT = 32 * 1024
+
+
+def drain_response(res, chunk_size=16384):
+    # 残りの大きさが分からない場合や大きい場合は読み込まず、接続を閉じる
+    remaining = getattr(res, 'remaining', None)
+    if remaining is None or remaining > _DRAIN_LIMIT:
+        logger.debug('視聴ページの残り (%s バイト) は受信せずに接続を閉じます。', remaining)
+        return
+    while res.read(chunk_size):
+        pass
+
+
+def read_api_data(res, chunk_size=16384):
+    # 視聴ページを少しずつ読み込み、data-api-data 属性を読み終えた時点で解析を止める
+    # 見つからない場合は、読み込んだページ全体を返す
+    buffer = bytearray()
+    offset = 0
+    while True:
+        start = buffer.find(_WATCH_DATA_MARKER, offset)
+        if start >= 0:
+            tag_start = max(0, buffer.rfind(b'<', 0, start))
+            attr = buffer.find(_API_DATA_ATTR, tag_start)
+            tag_end = buffer.find(b'>', tag_start)
+            if attr >= 0 and (tag_end < 0 or attr < tag_end):
+                value_start = attr + len(_API_DATA_ATTR)
+                value_end = buffer.find(b'"', value_start)
+                if value_end >= 0:
+                    drain_response(res, chunk_size)
+                    return html.unescape(buffer[value_start:value_end].decode()), None
+            elif tag_end >= 0:
+                offset = start + 1
+        else:
+            offset = max(0, len(buffer) - len(_WATCH_DATA_MARKER))
+        chunk = res.read(chunk_size)
+        if not chunk:
+            return None, bytes(buffer)
+        buffer += chunk
+
+
+_JSON_TOKEN_REGEX = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+_JSON_DELIMITER_REGEX = re.compile(r'[\s,:]*')
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _skip_json_value(d, i):
+    if d[i] not in '[{':
+        return _JSON_DECODER.raw_decode(d, i)[1]
+    depth = 0
+    for m in _JSON_TOKEN_REGEX.finditer(d, i):
+        token = m.group()
+        if token in '[{':
+            depth += 1
+        elif token in ']}':
+            depth -= 1
+            if depth == 0:
+                return m.end()
+    raise ValueError('unterminated JSON value')
+
+
+def extract_json_fields(d, keys):
+    # 最上位オブジェクトのうち keys に含まれる値だけを解析し、それ以外は読み飛ばす
+    result = {}
+    i = _JSON_DELIMITER_REGEX.match(d, 0).end()
+    if d[i] != '{':
+        raise ValueError('JSON object expected')
+    i += 1
+    while len(result) < len(keys):
+        i = _JSON_DELIMITER_REGEX.match(d, i).end()
+        if d[i] == '}':
+            break
+        key, i = _JSON_DECODER.raw_decode(d, i)
+        i = _JSON_DELIMITER_REGEX.match(d, i).end()
+        if key in keys:
+            result[key], i = _JSON_DECODER.raw_decode(d, i)
+        else:
+            i = _skip_json_value(d, i)
+    return result
+
+
 class VideoInfoError(Exception):
+    def __init__(self, *args, is_auth_error=False):
+        super().__init__(*args)
+        self.is_auth_error = is_auth_error
+
+
+class ThreadError(Exception):
     pass
 
 
@@ -81,11 +211,24 @@ class VideoInfo:
     def init(self, d):
         if self.done:
             return
+        try:
+            data = extract_json_fields(d, ('viewer', 'thread', 'video'))
+            self.user_id = int(data['viewer']['id'])
+            self.thread_id = data['thread']['ids']['default']
+            self.duration = int(data['video']['duration'])
+            self.title = data['video']['title']
+            self.attr = 'NORMAL'
+            self.done = True
+            return
+        except Exception:
+            logger.debug('動画情報JSONの部分解析に失敗したため、全体を解析します。')
         try:
             data = json.loads(d)
         except:
             logger.debug('JSON: %s' % d)
             raise VideoInfoError('JSONの解析に失敗しました。')
+        if isinstance(data, dict) and 'viewer' in data and not data['viewer']:
+            raise VideoInfoError('ログインしていない状態の動画情報です。', is_auth_error=True)
         try:
             self.user_id = int(data['viewer']['id'])
             self.thread_id = data['thread']['ids']['default']
@@ -103,6 +246,8 @@ class VideoInfo:
         except:
             logger.debug('動画情報クエリ文字列 - %s' % qs)
             raise VideoInfoError('動画情報クエリ文字列の解析に失敗しました。')
+        if 'closed' in data:
+            raise VideoInfoError('ログインしていない状態の動画情報です。', is_auth_error=True)
         try:
             self.user_id = int(data['user_id'][0])
             self.thread_id = data['thread_id'][0]
@@ -114,6 +259,23 @@ class VideoInfo:
             logger.debug('動画情報クエリ文字列 - %s' % qs)
             raise VideoInfoError('動画情報クエリ文字列の解析に失敗しました。')
 
+    def init_dict(self, d):
+        self.user_id = d['user_id']
+        self.thread_id = d['thread_id']
+        self.duration = d['duration']
+        self.title = d['title']
+        self.attr = d['attr']
+        self.done = True
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'thread_id': self.thread_id,
+            'duration': self.duration,
+            'title': self.title,
+            'attr': self.attr,
+        }
+
     def __repr__(self):
         return 'user_id=%d, thread_id=%s, duration=%d, title=%s, attr=%s' % (
             self.user_id, self.thread_id, self.duration, self.title, self.attr,
@@ -126,16 +288,21 @@ def get_video_info_flapi(r, video_id, attr):
             res = represent_default(req, res)
             qs = res.read().decode()
             video_info = VideoInfo()
-            video_info.init_flapi(qs, attr)
+            try:
+                video_info.init_flapi(qs, attr)
+            except VideoInfoError as err:
+                raise RepresentError(err, is_auth_error=err.is_auth_error)
             return video_info
         except RepresentError as err:
-            login(r)
+            if err.is_auth_error:
+                relogin(r, req)
             raise err
 
     logger.debug('flapi から %s の動画情報を取得します。' % video_id)
     return r.client.request(
         r.url.get_flapi_url(video_id),
         represent_func=represent,
+        endpoint='flapi',
     )
 
 
@@ -144,12 +311,14 @@ def get_video_info(r, video_id):
         try:
             res = represent_default(req, res)
             video_info = VideoInfo()
-            parser = VideoInfoParser(video_info)
-            data = res.read().decode()
+            api_data, page = read_api_data(res)
             try:
-                parser.feed(data)
+                if api_data is not None:
+                    video_info.init(api_data)
+                else:
+                    VideoInfoParser(video_info).feed(page.decode())
             except VideoInfoError as err:
-                raise RepresentError(err)
+                raise RepresentError(err, is_auth_error=err.is_auth_error)
             except:
                 pass
             if not video_info.done:
@@ -157,7 +326,8 @@ def get_video_info(r, video_id):
                 return get_video_info_flapi(r, video_id, 'NORMAL')
             return video_info
         except RepresentError as err:
-            login(r)
+            if err.is_auth_error:
+                relogin(r, req)
             raise err
 
     def handle_error(req, err):
@@ -173,15 +343,23 @@ def get_video_info(r, video_id):
                     return get_video_info_flapi(r, video_id, 'DELETED')
             raise err
 
+    cached = r.metadata.get_video_info(video_id)
+    if cached:
+        video_info = VideoInfo()
+        video_info.init_dict(cached)
+        logger.debug('%s のキャッシュ済みの動画情報を使用します。 - %s' % (video_id, video_info))
+        return video_info
     logger.debug('%s の動画情報を取得します。' % video_id)
     video_info = r.client.request(
         r.url.get_video_url(video_id),
         represent_func=represent,
         handle_error_func=handle_error,
+        endpoint='watch',
     )
     if not video_info:
         abort('動画情報の取得に失敗しました。(video_id=%s)' % video_id, logger)
     logger.debug('%s 動画情報を取得しました。 - %s' % (video_id, video_info))
+    r.metadata.set_video_info(video_id, video_info.to_dict())
     return video_info
 
 
@@ -194,41 +372,75 @@ def get_waybackkey(r, thread_id):
             waybackkey = data_dict.get('waybackkey', [''])[0]
             if not waybackkey:
                 logger.debug('waybackkey クエリ文字列 - %s' % data)
-                raise RepresentError('waybackkey の解析に失敗しました。', is_server_error=True)
+                # ログインしていない場合は、空の waybackkey が返る
+                raise RepresentError('waybackkey の解析に失敗しました。', is_server_error=True, is_auth_error=True)
             return waybackkey
         except RepresentError as err:
-            login(r)
+            if err.is_auth_error:
+                relogin(r, req)
             raise err
 
+    waybackkey = r.metadata.get_waybackkey(thread_id)
+    if waybackkey:
+        logger.debug('thread_id=%s のキャッシュ済みの waybackkey を使用します。 - %s', thread_id, waybackkey)
+        return waybackkey
     logger.debug('thread_id=%s の waybackkey を取得します。' % thread_id)
     waybackkey = r.client.request(
         r.url.get_waybackkey_url(thread_id),
         represent_func=represent,
+        endpoint='waybackkey',
     )
     if not waybackkey:
         abort('waybackkey の取得に失敗しました。(thread_id=%s)' % thread_id, logger)
     logger.debug('thread_id=%s の waybackkey を取得しました。 - %s', thread_id, waybackkey)
+    r.metadata.set_waybackkey(thread_id, waybackkey)
     return waybackkey
 
 
-def get_comments(r, video_info, waybackkey, when, last_no):
+COMMENT_PAGE_SIZE = 1000
+
+
+class CommentPage(list):
+    # 集計対象のコメントに加えて、絞り込む前のページ全体の件数と最新・最古のコメントを保持する
+    def __init__(self):
+        super().__init__()
+        self.raw_count = 0
+        self.newest_no = None
+        self.oldest_no = None
+        self.oldest_date = None
+
+    def observe(self, chat):
+        self.raw_count += 1
+        if self.newest_no is None or chat['no'] > self.newest_no:
+            self.newest_no = chat['no']
+        if self.oldest_no is None or chat['no'] < self.oldest_no:
+            self.oldest_no = chat['no']
+            self.oldest_date = chat['date']
+
+
+def get_comments(r, video_info, waybackkey, when, last_no, min_no=None):
     def represent(req, res):
         try:
             res = represent_default(req, res)
             data = res.read().decode()
-            rows = json.loads(data)
+            with r.metrics.time('json_decode_seconds', stage='comments'):
+                rows = json.loads(data)
             start = r.config.counter.start.timestamp()
             end = r.config.counter.end.timestamp()
-            result = []
+            result = CommentPage()
             for row in rows:
+                if 'chat' in row:
+                    result.observe(row['chat'])
                 if 'chat' in row and start <= row['chat']['date'] <= end and (
-                        last_no is None or last_no > row['chat']['no']):
+                        last_no is None or last_no > row['chat']['no']) and (
+                        min_no is None or min_no < row['chat']['no']):
                     result.append(row['chat'])
                 elif 'thread' in row and row['thread']['resultcode'] != 0:
-                    abort('コメントデータのパラメータが不正です。', logger)
+                    return ThreadError('コメントデータのパラメータが不正です。(resultcode=%s)' % row['thread']['resultcode'])
             return result
         except RepresentError as err:
-            login(r)
+            if err.is_auth_error:
+                relogin(r, req)
             raise err
 
     data = [
@@ -237,7 +449,7 @@ def get_comments(r, video_info, waybackkey, when, last_no):
         {'thread': {
             'fork': 0,
             'nicoru': 0,
-            'res_from': -1000,
+            'res_from': -COMMENT_PAGE_SIZE,
             'scores': 1,
             'thread': video_info.thread_id,
             'user_id': str(video_info.user_id),
@@ -257,50 +469,177 @@ def get_comments(r, video_info, waybackkey, when, last_no):
         },
         data=json.dumps(data),
         represent_func=represent,
+        endpoint='comments',
     )
     if comments is None:
         abort('コメントの取得に失敗しました。', logger)
+    if isinstance(comments, ThreadError):
+        raise comments
     logger.debug('%d 件のコメントを取得しました。', len(comments))
+    r.metrics.observe('comments_per_page', len(comments))
+    r.metrics.inc('comments_total', len(comments))
     return comments
 
 
-def generate_result_csv(r):
-    videos = load_videos(r)
-    login(r)
-    i = 0
-    for video_id, video_title in videos.items():
-        i += 1
-        comment_csv = r.path.get_comment_csv(video_id)
-        comment_temp_csv = r.path.get_comment_temp_csv(video_id)
-        if not r.incomplete_cache and path.isfile(comment_csv):
-            puts('%s のコメント取得をスキップ (%d / %d)' % (video_id, i, len(videos)), logger)
-            continue
+def load_comment_state(r, store):
+    # 記録後に書き込まれた未確定の行は切り詰めて、最後に確定したページから再開する
+    state = load_json(r.path.get_comment_state(store.video_id))
+    if not state or not store.restore(state.get('position')):
+        return None
+    return state
+
+
+def save_comment_state(r, store, max_no, max_date, summary=None, cursor=None):
+    # 集計サマリーはページごとには保存せず、スレッドの取得を終えたときだけ保存する
+    dump_json(r.path.get_comment_state(store.video_id), {
+        'position': store.position(),
+        'max_no': max_no,
+        'max_date': max_date,
+        'summary': summary.to_dict() if summary else None,
+        'cursor': cursor,
+    })
+
+
+def fetch_video_comments(r, video_id, video_title, i, count):
+    if r.stop_event.is_set():
+        sys.exit(1)
+    store = open_comment_store(r, video_id)
+    if not r.incomplete_cache and store.exists(True):
+        puts('%s のコメント取得をスキップ (%d / %d)' % (video_id, i, count), logger)
+        return
+    else:
+        puts('%s のコメント取得を開始 (%d / %d)' % (video_id, i, count), logger)
+    state = load_comment_state(r, store)
+    cache = CommentCache(r, video_id) if state is None and r.path.comment_cache_dir else None
+    try:
+        if cache and cache.covers():
+            # 集計期間全体を取得済みの場合は、通信せずにコメントキャッシュから読み込む
+            logger.debug('%s のコメントをコメントキャッシュから読み込みます。', video_id)
+            summary = copy_comments(r, store, video_title, cache.read())
+        elif state is None and r.path.shared_dir:
+            # 同じ起動の他の作業フォルダで取得済みの場合は、そのコメントを使用する
+            with SharedComments(r, video_id) as shared:
+                if shared.exists():
+                    logger.debug('%s のコメントを共有キャッシュから読み込みます。', video_id)
+                    summary = copy_comments(r, store, video_title, shared.read())
+                else:
+                    summary = download_video_comments(r, store, video_id, video_title, state, shared, cache)
+                    shared.commit()
+                    if cache:
+                        cache.commit()
         else:
-            puts('%s のコメント取得を開始 (%d / %d)' % (video_id, i, len(videos)), logger)
-        video_info = get_video_info(r, video_id)
-        waybackkey = get_waybackkey(r, video_info.thread_id)
-        when = int(r.config.counter.end.timestamp())
-        last_no = None
-        with open(comment_temp_csv, mode='w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as f:
-            writer = csv.writer(f, lineterminator='\n')
-            writer.writerow((
-                '動画ID',
-                '動画タイトル',
-                '動画属性',
-                'コメント番号',
-                'ユーザーID',
-                'プレミアム会員フラグ',
-                '匿名フラグ',
-                '削除フラグ',
-                'VPOS',
-                'NGスコア',
-                'コマンド',
-                'コメント',
-                '書き込み日時',
-            ))
+            summary = download_video_comments(r, store, video_id, video_title, state, cache)
+            if cache:
+                cache.commit()
+    finally:
+        if cache:
+            cache.discard()
+    if not r.incomplete_cache:
+        if summary:
+            dump_json(r.path.get_comment_summary(video_id), summary.to_dict())
+        store.finalize()
+        os.remove(r.path.get_comment_state(video_id))
+
+
+def copy_comments(r, store, video_title, pages):
+    title, attr = next(pages)
+    title = video_title or title
+    max_no, max_date = 0, 0
+    summary = new_comment_summary(r)
+    store.open(False)
+    try:
+        for comments in pages:
+            for comment in comments:
+                if comment['no'] > max_no:
+                    max_no = comment['no']
+                    max_date = comment['date']
+                summary.add_comment(title, comment)
+            try:
+                store.write(title, attr, comments)
+            except Exception as err:
+                abort(err, logger)
+        save_comment_state(r, store, max_no, max_date, summary)
+    finally:
+        store.close()
+    return summary
+
+
+def record_skipped_pages(r, video_id, oldest_no):
+    # 集計開始前のコメントしか残っていないため、取得せずに済んだページ数を記録する
+    pages = (oldest_no - 1 + COMMENT_PAGE_SIZE - 1) // COMMENT_PAGE_SIZE
+    if pages == 0:
+        return
+    logger.debug('%s のコメント番号 %d より前は集計開始前のため、%d ページの取得を省略します。', video_id, oldest_no, pages)
+    r.metrics.inc('comment_pages_skipped_total', pages)
+
+
+def download_video_comments(r, store, video_id, video_title, state, *sinks):
+    video_info = get_video_info(r, video_id)
+    waybackkey = get_waybackkey(r, video_info.thread_id)
+    if state:
+        max_no, max_date, cursor = state['max_no'], state['max_date'], state.get('cursor')
+        # 取得の途中で中断した場合は、確定済みの位置までのコメントから集計サマリーを作り直す
+        summary = restore_comment_summary(r, state.get('summary'))
+        if summary is None:
+            summary = summarize_comment_store(r, store, False)
+    else:
+        max_no, max_date, cursor = 0, 0, None
+        summary = new_comment_summary(r)
+    title = video_title or video_info.title
+    delta = state is not None
+    refreshed = False
+    store.open(delta)
+    # 取得したコメントを共有キャッシュやコメントキャッシュにも書き込む
+    sinks = [sink for sink in sinks if sink]
+    for sink in sinks:
+        sink.begin(video_info.title, video_info.attr)
+    try:
+        while True:
+            if cursor:
+                logger.debug('%s のコメント取得を中断位置から再開します。 - %s', video_id, cursor)
+                when, last_no, min_no = cursor['when'], cursor['last_no'], cursor['min_no']
+            else:
+                when, last_no, min_no = int(r.config.counter.end.timestamp()), None, max_no if delta else None
+                if min_no is not None:
+                    logger.debug('%s のコメント番号 %d より後のコメントを取得します。', video_id, min_no)
+            start = int(r.config.counter.start.timestamp())
+            # probing が真の場合は、前のページの最古の秒を含めずに取得している (重複なし)
+            probing = False
+            probes = gaps = 0
+            oldest_no = oldest_date = None
             while True:
-                comments = get_comments(r, video_info, waybackkey, when, last_no)
+                if r.stop_event.is_set():
+                    logger.debug('%s のコメント取得を中断します。', video_id)
+                    sys.exit(1)
+                try:
+                    comments = get_comments(r, video_info, waybackkey, when, last_no, min_no)
+                except ThreadError as err:
+                    # キャッシュ済みの waybackkey が無効になった場合は、一度だけ取得し直す
+                    if refreshed:
+                        abort(err, logger)
+                    logger.debug('thread_id=%s の waybackkey を取得し直します。', video_info.thread_id)
+                    r.metadata.remove_waybackkey(video_info.thread_id)
+                    waybackkey = get_waybackkey(r, video_info.thread_id)
+                    refreshed = True
+                    continue
+                if probing and oldest_no > 1 and comments.newest_no != oldest_no - 1:
+                    # 前のページの最古の秒に、まだ取得していないコメントが残っているため、その秒を含めて取得し直す
+                    logger.debug('%s の %d 秒のコメントを重複ありで取得し直します。', video_id, oldest_date)
+                    r.metrics.inc('comment_page_refetches_total')
+                    gaps += 1
+                    when, probing = oldest_date, False
+                    continue
                 if len(comments) == 0:
+                    if comments.oldest_no is not None and last_no is not None and comments.oldest_no >= last_no \
+                            and comments.oldest_date >= when and comments.raw_count >= COMMENT_PAGE_SIZE:
+                        # 1秒間に1ページを超えるコメントがあり、この秒の残りは取得できないため、次の秒に進む
+                        logger.warning('%s の %d 秒にコメントが集中しているため、一部のコメントを取得できません。',
+                                       video_id, when)
+                        r.metrics.inc('comment_dense_seconds_total')
+                        when, probing = when - 1, False
+                        continue
+                    if comments.oldest_date is not None and comments.oldest_date < start:
+                        record_skipped_pages(r, video_id, comments.oldest_no)
                     break
                 comments.reverse()
                 for comment in comments:
@@ -308,100 +647,92 @@ def generate_result_csv(r):
                         when = comment['date']
                     if last_no is None or comment['no'] < last_no:
                         last_no = comment['no']
-                    try:
-                        writer.writerow((
-                            video_id,
-                            video_title or video_info.title,
-                            video_info.attr,
-                            comment['no'],
-                            comment.get('user_id', ''),
-                            comment.get('premium', 0),
-                            comment.get('anonymity', 0),
-                            comment.get('deleted', 0),
-                            comment['vpos'],
-                            comment.get('score', 0),
-                            comment.get('mail', ''),
-                            comment.get('content', ''),
-                            datetime.fromtimestamp(comment['date'], tz=TZ).strftime('%Y-%m-%d %H:%M:%S'),
-                        ))
-                    except Exception as err:
-                        abort(err, logger)
-                if last_no == 1:
+                    if comment['no'] > max_no:
+                        max_no = comment['no']
+                        max_date = comment['date']
+                    summary.add_comment(title, comment)
+                try:
+                    with r.metrics.time('store_write_seconds', store=r.config.counter.store):
+                        store.write(title, video_info.attr, comments)
+                except Exception as err:
+                    abort(err, logger)
+                for sink in sinks:
+                    sink.write(comments)
+                if last_no == 1 or (min_no is not None and last_no <= min_no + 1):
                     break
-        if not r.incomplete_cache:
-            shutil.move(comment_temp_csv, comment_csv)
-
-    result_csv = r.path.get_result_csv(r.incomplete_cache)
-    result_temp_csv = r.path.result_temp_csv
-    with open(result_temp_csv, mode='w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as wf:
-        writer = csv.writer(wf, lineterminator='\n')
-        writer.writerow((
-            '動画ID',
-            '動画タイトル',
-            'プレミアム会員ユニークコメント数',
-            '匿名プレミアム会員ユニークコメント数',
-            '一般会員ユニークコメント数',
-            '匿名一般会員ユニークコメント数',
-            'プレミアム会員コメント数',
-            '匿名プレミアム会員コメント数',
-            '一般会員コメント数',
-            '匿名一般会員コメント数',
-        ))
-        for video_id, video_title in videos.items():
-            result = {
-                'unique_premium': set(),
-                'unique_premium_184': set(),
-                'unique_general': set(),
-                'unique_general_184': set(),
-                'count_premium': 0,
-                'count_premium_184': 0,
-                'count_general': 0,
-                'count_general_184': 0,
-            }
-            title = None
-            comment_csv = r.path.get_comment_temp_csv(video_id) \
-                if r.incomplete_cache else r.path.get_comment_csv(video_id)
-            if path.isfile(comment_csv):
-                with open(comment_csv, 'r', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as rf:
-                    reader = csv.reader(rf)
-                    row = next(reader)
-                    if row[0] != '動画ID':
-                        abort('コメントファイル "%s" が不正です。' % comment_csv, logger)
-                    for row in reader:
-                        if title is None:
-                            title = row[1]
-                        if row[4] == '':
-                            continue
-                        if row[5] == '1':
-                            if row[6] == '1':
-                                result['unique_premium_184'].add(row[4])
-                                result['count_premium_184'] += 1
-                            else:
-                                result['unique_premium'].add(row[4])
-                                result['count_premium'] += 1
-                        else:
-                            if row[6] == '1':
-                                result['unique_general_184'].add(row[4])
-                                result['count_general_184'] += 1
-                            else:
-                                result['unique_general'].add(row[4])
-                                result['count_general'] += 1
-            try:
-                writer.writerow((
-                    video_id,
-                    video_title or title or '',
-                    len(result['unique_premium']),
-                    len(result['unique_premium_184']),
-                    len(result['unique_general']),
-                    len(result['unique_general_184']),
-                    result['count_premium'],
-                    result['count_premium_184'],
-                    result['count_general'],
-                    result['count_general_184'],
-                ))
-            except Exception as err:
-                abort(err, logger)
-    if path.isfile(result_csv):
-        os.remove(result_csv)
-    shutil.move(result_temp_csv, result_csv)
-    puts('集計結果を %s に出力しました。' % result_csv, logger)
+                # ページが埋まっていない場合はスレッドの先頭に、最古のコメントが集計開始前の場合は集計期間の先頭に達している
+                if comments.raw_count < COMMENT_PAGE_SIZE or (
+                        min_no is not None and comments.oldest_no <= min_no + 1):
+                    break
+                if comments.oldest_date < start:
+                    record_skipped_pages(r, video_id, comments.oldest_no)
+                    break
+                # 中断時は重複ありの位置から再開する
+                save_comment_state(r, store, max_no, max_date, cursor={
+                    'when': when,
+                    'last_no': last_no,
+                    'min_no': min_no,
+                })
+                # 重複なしで取得し直しになる割合が高いスレッドでは、最初から最古の秒を含めて取得する
+                oldest_no, oldest_date = comments.oldest_no, comments.oldest_date
+                probing = gaps * 2 <= probes
+                if probing:
+                    probes += 1
+                    when = oldest_date - 1
+                else:
+                    when = oldest_date
+            save_comment_state(r, store, max_no, max_date, summary)
+            # 中断位置から再開した場合は、中断中に増えたコメントを続けて取得する
+            if not cursor:
+                break
+            cursor = None
+            delta = True
+    finally:
+        store.close()
+    return summary
+
+
+def select_videos(r, videos, changed_videos=None):
+    # 集計期間が終了していれば、追加された動画以外で取得済みの動画はコメント取得の対象にしない
+    # 前回の実行が途中で終了した場合に備えて、変更のない動画も取得済みかどうかは確認する
+    if r.incomplete_cache or changed_videos is None:
+        return videos
+    selected = OrderedDict((video_id, video_title) for video_id, video_title in videos.items()
+                           if video_id in changed_videos or not open_comment_store(r, video_id).exists(True))
+    if len(selected) < len(videos):
+        puts('取得済みの %d 件の動画のコメント取得をスキップします。' % (len(videos) - len(selected)), logger)
+    return selected
+
+
+def fetch_comments(r, videos):
+    count = len(videos)
+    tasks = [(video_id, video_title, i + 1) for i, (video_id, video_title) in enumerate(videos.items())]
+    if r.config.http.concurrency < 2:
+        for video_id, video_title, i in tasks:
+            fetch_video_comments(r, video_id, video_title, i, count)
+        return
+    logger.debug('%d 並列でコメントを取得します。', r.config.http.concurrency)
+    with ThreadPoolExecutor(max_workers=r.config.http.concurrency) as executor:
+        futures = [executor.submit(fetch_video_comments, r, video_id, video_title, i, count)
+                   for video_id, video_title, i in tasks]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            r.stop_event.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def generate_result_csv(r, changed_videos=None):
+    videos = load_videos(r)
+    selected = select_videos(r, videos, changed_videos)
+    # コメントを取得する動画がなければ、ログインもしない
+    if selected:
+        with measure('ログイン', logger, r.metrics):
+            restore_session(r)
+        with measure('コメント取得', logger, r.metrics):
+            fetch_comments(r, selected)
+    with measure('集計', logger, r.metrics):
+        write_result_csv(r, videos)
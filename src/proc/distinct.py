@@ -0,0 +1,105 @@
+# coding: utf-8
+
+__all__ = [
+    'ExactCounter',
+    'HyperLogLog',
+    'create_counter',
+    'load_counter',
+]
+
+import re, math, hashlib, base64
+
+_NUMERIC_USER_ID_REGEX = re.compile(r'^[1-9][0-9]{0,17}$')
+
+
+def hash_user_id(user_id):
+    return int.from_bytes(hashlib.md5(user_id.encode('utf-8')).digest()[:8], 'big')
+
+
+def user_key(user_id):
+    # 数値の会員IDはそのまま整数に、匿名IDは最上位ビットを立てた63ビットのハッシュ値にする
+    if _NUMERIC_USER_ID_REGEX.match(user_id):
+        return int(user_id)
+    return (hash_user_id(user_id) >> 1) | (1 << 63)
+
+
+class ExactCounter:
+    error = 0.0
+
+    def __init__(self, values=()):
+        self._values = set(values)
+
+    @property
+    def kind(self):
+        return ('exact',)
+
+    def add(self, user_id):
+        self._values.add(user_key(user_id))
+
+    def __len__(self):
+        return len(self._values)
+
+    def to_data(self):
+        return {'type': 'exact', 'values': sorted(self._values)}
+
+
+class HyperLogLog:
+    def __init__(self, precision, registers=None):
+        self.precision = precision
+        self._m = 1 << precision
+        self._registers = bytearray(registers) if registers else bytearray(self._m)
+
+    @property
+    def kind(self):
+        return ('hll', self.precision)
+
+    @property
+    def error(self):
+        return 1.04 / math.sqrt(self._m)
+
+    def add(self, user_id):
+        h = hash_user_id(user_id)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def __len__(self):
+        m = self._m
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_data(self):
+        return {
+            'type': 'hll',
+            'precision': self.precision,
+            'registers': base64.b64encode(bytes(self._registers)).decode('ascii'),
+        }
+
+
+def hll_precision(error):
+    return min(18, max(4, int(math.ceil(math.log2((1.04 / error) ** 2)))))
+
+
+def create_counter(mode, error):
+    if mode == 'hll':
+        return HyperLogLog(hll_precision(error))
+    return ExactCounter()
+
+
+def load_counter(data):
+    if data['type'] == 'hll':
+        return HyperLogLog(data['precision'], base64.b64decode(data['registers']))
+    return ExactCounter(data['values'])
@@ -0,0 +1,78 @@
+# coding: utf-8
+
+__all__ = [
+    'reaggregate_result_csv',
+    'export_comment_csv',
+]
+
+import os
+from os import path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+from util import *
+from .aggregate import (
+    new_comment_summary,
+    summarize_comment_store,
+    write_result_csv,
+)
+from .comments import load_videos
+from .store import open_comment_store
+
+logger = getLogger(__name__)
+
+
+class AggregateContext:
+    # 子プロセスで集計するために、Resource のうち集計に必要な部分だけを持つ
+    def __init__(self, r):
+        self.path = r.path
+        self.config = r.config
+        self.incomplete_cache = r.incomplete_cache
+
+
+def summarize_video(r, video_id):
+    # 保存済みの集計サマリーは使わず、現在の設定でコメントファイルから集計し直す
+    store = open_comment_store(r, video_id)
+    complete = not r.incomplete_cache
+    summary = summarize_comment_store(r, store, complete) if store.exists(complete) else new_comment_summary(r)
+    return summary.title, summary.row()
+
+
+def reaggregate_result_csv(r, workers=None):
+    # 取得済みのコメントファイルだけを読み込み、通信せずに result.csv を作り直す
+    if not path.isfile(r.path.videos_csv):
+        abort('動画リストファイル "%s" がありません。' % r.path.videos_csv, logger)
+    videos = load_videos(r)
+    complete = not r.incomplete_cache
+    missing = [video_id for video_id in videos if not open_comment_store(r, video_id).exists(complete)]
+    if missing:
+        logger.warning('コメントを取得していない %d 件の動画は、コメント数 0 件として集計します。 - %s',
+                       len(missing), ', '.join(missing))
+    workers = min(workers or os.cpu_count() or 1, len(videos))
+    context = AggregateContext(r)
+    if workers < 2:
+        rows = {video_id: summarize_video(context, video_id) for video_id in videos}
+    else:
+        logger.debug('%d プロセスで再集計します。', workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = dict(zip(videos, executor.map(partial(summarize_video, context), videos)))
+    write_result_csv(r, videos, rows)
+
+
+def export_comment_csv(r):
+    # store = "binary" で保存したコメントを、動画ごとの CSV ファイルに書き出す
+    if r.config.counter.store != 'binary':
+        abort('store = "binary" の場合だけ、コメントファイルを CSV ファイルに書き出せます。', logger)
+    if not path.isfile(r.path.videos_csv):
+        abort('動画リストファイル "%s" がありません。' % r.path.videos_csv, logger)
+    videos = load_videos(r)
+    count = 0
+    for video_id in videos:
+        store = open_comment_store(r, video_id)
+        if not store.exists(True):
+            logger.debug('%s のコメントは取得を終えていないため、書き出しません。', video_id)
+            continue
+        store.export_csv(r.path.get_comment_csv(video_id))
+        count += 1
+    puts('%d 件の動画のコメントを %s に書き出しました。' % (count, r.path.comment_dir), logger)
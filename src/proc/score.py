@@ -0,0 +1,42 @@
+# coding: utf-8
+
+__all__ = [
+    'compute_scores',
+    'rank_scores',
+    'format_score',
+]
+
+from config import SCORE_STATS
+
+
+def compute_scores(config, rows):
+    # 全動画の集計値を列ごとにまとめ、列単位で重みを掛けて評価値を計算する
+    # rows は動画ごとの集計値 (SCORE_STATS の順) のリスト
+    columns = dict(zip(SCORE_STATS, zip(*rows))) if rows else {}
+    scores = [0] * len(rows)
+    for stat, column in columns.items():
+        weight = getattr(config, stat)
+        if weight:
+            scores = [score + weight * value for score, value in zip(scores, column)]
+    for stat, weight, power in config.terms:
+        column = columns.get(stat, ())
+        scores = [score + weight * value ** power for score, value in zip(scores, column)]
+    return scores
+
+
+def rank_scores(scores):
+    # 評価値の降順の並びと、同じ評価値を同順位とする順位 (1, 2, 2, 4, ...) を返す
+    order = sorted(range(len(scores)), key=lambda i: -scores[i])
+    ranks = [0] * len(scores)
+    for position, i in enumerate(order):
+        if position > 0 and scores[i] == scores[order[position - 1]]:
+            ranks[i] = ranks[order[position - 1]]
+        else:
+            ranks[i] = position + 1
+    return order, ranks
+
+
+def format_score(score):
+    if score == int(score):
+        return '%d' % score
+    return '%.4f' % score
@@ -0,0 +1,58 @@
+# coding: utf-8
+
+__all__ = ['SharedComments']
+
+import os, json
+from os import path
+from logging import getLogger
+
+from filelock import FileLock
+
+logger = getLogger(__name__)
+
+
+class SharedComments:
+    # 同じ起動で処理する他の作業フォルダと、同じ期間のコメント取得結果を共有する
+    # 1行目に動画タイトルと動画属性、2行目以降に取得したページごとのコメントを保存する
+    def __init__(self, r, video_id):
+        self.video_id = video_id
+        self._file = r.path.get_shared_comments(video_id)
+        self._temp_file = self._file + '.tmp'
+        self._lock = FileLock(self._file + '.lock')
+        self._out = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._out:
+            self._out.close()
+            self._out = None
+            os.remove(self._temp_file)
+        self._lock.release()
+
+    def exists(self):
+        return path.isfile(self._file)
+
+    def read(self):
+        with open(self._file, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            yield header['title'], header['attr']
+            for line in f:
+                yield json.loads(line)
+
+    def begin(self, title, attr):
+        self._out = open(self._temp_file, 'w', encoding='utf-8')
+        self._out.write(json.dumps({'title': title, 'attr': attr}, ensure_ascii=False) + '\n')
+
+    def write(self, comments):
+        if self._out:
+            self._out.write(json.dumps(comments, ensure_ascii=False) + '\n')
+
+    def commit(self):
+        if self._out:
+            self._out.close()
+            self._out = None
+            os.replace(self._temp_file, self._file)
+            logger.debug('%s のコメントを共有キャッシュに保存しました。', self.video_id)
@@ -0,0 +1,446 @@
+# coding: utf-8
+
+__all__ = [
+    'COMMENT_CSV_HEADER',
+    'open_comment_store',
+]
+
+import csv, os, shutil, sys, mmap
+from os import path
+from array import array
+from itertools import repeat
+from datetime import datetime, timezone
+from contextlib import contextmanager, ExitStack
+from logging import getLogger
+
+from util import *
+
+logger = getLogger(__name__)
+
+COMMENT_CSV_HEADER = (
+    '動画ID',
+    '動画タイトル',
+    '動画属性',
+    'コメント番号',
+    'ユーザーID',
+    'プレミアム会員フラグ',
+    '匿名フラグ',
+    '削除フラグ',
+    'VPOS',
+    'NGスコア',
+    'コマンド',
+    'コメント',
+    '書き込み日時',
+)
+
+
+def _utc_offset(date):
+    return int(datetime.fromtimestamp(date, tz=TZ).utcoffset().total_seconds())
+
+
+class DateFormatter:
+    # 書き込み日時を '%Y-%m-%d %H:%M:%S' 形式にする
+    # タイムゾーンの時差は UTC の15分単位で、日付部分は現地時刻の日単位でキャッシュする
+    def __init__(self):
+        self._offsets = {}
+        self._days = {}
+
+    def __call__(self, date):
+        date = int(date)
+        block = date // 900
+        offset = self._offsets.get(block)
+        if offset is None:
+            start, end = _utc_offset(block * 900), _utc_offset(block * 900 + 899)
+            # 15分の途中で時差が変わる区間は、キャッシュせずに1件ずつ変換する
+            offset = self._offsets[block] = start if start == end else False
+        if offset is False:
+            return datetime.fromtimestamp(date, tz=TZ).strftime('%Y-%m-%d %H:%M:%S')
+        day, seconds = divmod(date + offset, 86400)
+        prefix = self._days.get(day)
+        if prefix is None:
+            prefix = self._days[day] = datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%Y-%m-%d ')
+        hour, seconds = divmod(seconds, 3600)
+        minute, second = divmod(seconds, 60)
+        return '%s%02d:%02d:%02d' % (prefix, hour, minute, second)
+
+
+format_date = DateFormatter()
+
+
+class CsvCommentStore:
+    # 動画ごとのコメントを counter.encoding の CSV ファイルに保存する
+    def __init__(self, r, video_id):
+        self._r = r
+        self.video_id = video_id
+        self.temp_path = r.path.get_comment_temp_csv(video_id)
+        self.path = r.path.get_comment_csv(video_id)
+        self._file = None
+        self._writer = None
+
+    def exists(self, complete):
+        return path.isfile(self.path if complete else self.temp_path)
+
+    def restore(self, position):
+        if not isinstance(position, int) or not path.isfile(self.temp_path) or path.getsize(self.temp_path) < position:
+            return False
+        if path.getsize(self.temp_path) > position:
+            logger.debug('"%s" を %d バイトに切り詰めます。', self.temp_path, position)
+            with open(self.temp_path, 'r+b') as f:
+                f.truncate(position)
+        return True
+
+    def open(self, resume):
+        self._file = open(self.temp_path, mode='a' if resume else 'w', encoding=self._r.config.counter.encoding,
+                          errors='xmlcharrefreplace')
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        if not resume:
+            self._writer.writerow(COMMENT_CSV_HEADER)
+
+    def write(self, title, attr, comments):
+        # ページ単位でまとめて書き込む
+        video_id = self.video_id
+        self._writer.writerows([(
+            video_id,
+            title,
+            attr,
+            comment['no'],
+            comment.get('user_id', ''),
+            comment.get('premium', 0),
+            comment.get('anonymity', 0),
+            comment.get('deleted', 0),
+            comment['vpos'],
+            comment.get('score', 0),
+            comment.get('mail', ''),
+            comment.get('content', ''),
+            format_date(comment['date']),
+        ) for comment in comments])
+
+    def position(self):
+        self._file.flush()
+        return path.getsize(self.temp_path)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+    def finalize(self):
+        shutil.move(self.temp_path, self.path)
+
+    def _reader(self, complete):
+        file = self.path if complete else self.temp_path
+        with open(file, 'r', encoding=self._r.config.counter.encoding, errors='xmlcharrefreplace') as f:
+            reader = csv.reader(f)
+            row = next(reader)
+            if row[0] != COMMENT_CSV_HEADER[0]:
+                abort('コメントファイル "%s" が不正です。' % file, logger)
+            for row in reader:
+                yield row
+
+    def iter_fields(self, complete):
+        for row in self._reader(complete):
+            yield row[1], row[4], 1 if row[5] == '1' else 0, 1 if row[6] == '1' else 0, 1 if row[7] == '1' else 0
+
+
+# 固定長の列 (列名, array の型コード)
+_FIXED_COLUMNS = (
+    ('no', 'I'),
+    ('premium', 'B'),
+    ('anonymity', 'B'),
+    ('deleted', 'B'),
+    ('vpos', 'i'),
+    ('score', 'i'),
+    ('date', 'q'),
+    ('user', 'I'),
+)
+
+_CONTENT_COLUMNS = (
+    ('mail', 'I'),
+)
+
+
+@contextmanager
+def _map_column(file, typecode):
+    if not path.isfile(file) or path.getsize(file) == 0:
+        yield ()
+        return
+    with open(file, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(m)
+            column = view.cast(typecode)
+            try:
+                yield column
+            finally:
+                column.release()
+                view.release()
+        finally:
+            m.close()
+
+
+class StringTable:
+    # 可変長文字列を UTF-8 の連結データと終端オフセットの配列で保存する
+    def __init__(self, dir, name):
+        self._data_file = path.join(dir, '%s.bin' % name)
+        self._index_file = path.join(dir, '%s.idx' % name)
+        self._data = None
+        self._index = None
+        self._offset = 0
+
+    def restore(self, count):
+        index_size = count * 8
+        if not path.isfile(self._index_file) or not path.isfile(self._data_file) or \
+                path.getsize(self._index_file) < index_size:
+            return False
+        offset = 0
+        if count > 0:
+            with _map_column(self._index_file, 'Q') as index:
+                offset = index[count - 1]
+        if path.getsize(self._data_file) < offset:
+            return False
+        for file, size in ((self._index_file, index_size), (self._data_file, offset)):
+            with open(file, 'r+b') as f:
+                f.truncate(size)
+        return True
+
+    def open(self, resume):
+        mode = 'ab' if resume else 'wb'
+        self._data = open(self._data_file, mode)
+        self._index = open(self._index_file, mode)
+        self._offset = self._data.tell()
+
+    def append(self, values):
+        offsets = array('Q')
+        data = []
+        for value in values:
+            b = value.encode('utf-8')
+            self._offset += len(b)
+            offsets.append(self._offset)
+            data.append(b)
+        self._data.write(b''.join(data))
+        offsets.tofile(self._index)
+
+    def flush(self):
+        self._data.flush()
+        self._index.flush()
+
+    def close(self):
+        for f in (self._data, self._index):
+            if f:
+                f.close()
+        self._data = self._index = None
+
+    def read(self):
+        with open(self._data_file, 'rb') as f:
+            data = f.read()
+        result = []
+        start = 0
+        with _map_column(self._index_file, 'Q') as index:
+            for end in index:
+                result.append(data[start:end].decode('utf-8'))
+                start = end
+        return result
+
+
+class BinaryCommentStore:
+    # 動画ごとのコメントを列ごとのバイナリファイルに保存する
+    # ユーザーIDとコマンドは文字列表に登録し、その番号を列に保存する
+    def __init__(self, r, video_id):
+        self._r = r
+        self.video_id = video_id
+        self.temp_path = r.path.get_comment_temp_store(video_id)
+        self.path = r.path.get_comment_store(video_id)
+        self._content = r.config.counter.store_content
+        self._files = {}
+        self._tables = {}
+        self._interned = {}
+        self._rows = 0
+        self._meta = None
+
+    def _columns(self):
+        return _FIXED_COLUMNS + (_CONTENT_COLUMNS if self._content else ())
+
+    def _table_names(self):
+        return ('user', 'mail') if self._content else ('user',)
+
+    def _column_file(self, dir, name):
+        return path.join(dir, '%s.col' % name)
+
+    def _meta_file(self, dir):
+        return path.join(dir, 'meta.json')
+
+    def exists(self, complete):
+        return path.isfile(self._meta_file(self.path if complete else self.temp_path))
+
+    def restore(self, position):
+        if not isinstance(position, dict) or not self.exists(False):
+            return False
+        meta = load_json(self._meta_file(self.temp_path))
+        if not meta or meta.get('content') != self._content or meta.get('byteorder') != sys.byteorder:
+            return False
+        rows = position['rows']
+        for name, typecode in self._columns():
+            file = self._column_file(self.temp_path, name)
+            size = rows * array(typecode).itemsize
+            if not path.isfile(file) or path.getsize(file) < size:
+                return False
+        tables = [StringTable(self.temp_path, name) for name in self._table_names()]
+        if self._content:
+            tables.append(StringTable(self.temp_path, 'content'))
+        counts = [position[name] for name in self._table_names()] + ([rows] if self._content else [])
+        for table, count in zip(tables, counts):
+            if not table.restore(count):
+                return False
+        for name, typecode in self._columns():
+            with open(self._column_file(self.temp_path, name), 'r+b') as f:
+                f.truncate(rows * array(typecode).itemsize)
+        return True
+
+    def open(self, resume):
+        if not resume:
+            if path.isdir(self.temp_path):
+                shutil.rmtree(self.temp_path)
+            os.makedirs(self.temp_path)
+        mode = 'ab' if resume else 'wb'
+        for name, typecode in self._columns():
+            self._files[name] = open(self._column_file(self.temp_path, name), mode)
+        self._rows = self._files['no'].tell() // array('I').itemsize
+        for name in self._table_names() + (('content',) if self._content else ()):
+            self._tables[name] = StringTable(self.temp_path, name)
+            self._tables[name].open(resume)
+        for name in self._table_names():
+            values = self._tables[name].read() if resume else []
+            self._interned[name] = {value: i for i, value in enumerate(values)}
+        self._meta = load_json(self._meta_file(self.temp_path)) if resume else None
+        if not self._meta:
+            self._meta = {
+                'video_id': self.video_id,
+                'title': '',
+                'attr': '',
+                'content': self._content,
+                'byteorder': sys.byteorder,
+            }
+
+    def _intern(self, name, value, new_values):
+        interned = self._interned[name]
+        i = interned.get(value)
+        if i is None:
+            i = interned[value] = len(interned)
+            new_values.append(value)
+        return i
+
+    def write(self, title, attr, comments):
+        self._meta['title'] = title
+        self._meta['attr'] = attr
+        columns = {name: array(typecode) for name, typecode in self._columns()}
+        new_values = {name: [] for name in self._table_names()}
+        contents = []
+        for comment in comments:
+            columns['no'].append(comment['no'])
+            columns['premium'].append(int(comment.get('premium', 0)))
+            columns['anonymity'].append(int(comment.get('anonymity', 0)))
+            columns['deleted'].append(int(comment.get('deleted', 0)))
+            columns['vpos'].append(comment['vpos'])
+            columns['score'].append(comment.get('score', 0))
+            columns['date'].append(comment['date'])
+            columns['user'].append(self._intern('user', str(comment.get('user_id', '')), new_values['user']))
+            if self._content:
+                columns['mail'].append(self._intern('mail', comment.get('mail', ''), new_values['mail']))
+                contents.append(comment.get('content', ''))
+        for name, column in columns.items():
+            column.tofile(self._files[name])
+        for name, values in new_values.items():
+            self._tables[name].append(values)
+        if self._content:
+            self._tables['content'].append(contents)
+        self._rows += len(comments)
+
+    def position(self):
+        for f in self._files.values():
+            f.flush()
+        for table in self._tables.values():
+            table.flush()
+        dump_json(self._meta_file(self.temp_path), self._meta)
+        position = {'rows': self._rows}
+        for name in self._table_names():
+            position[name] = len(self._interned[name])
+        return position
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        for table in self._tables.values():
+            table.close()
+        self._files = {}
+        self._tables = {}
+        self._interned = {}
+
+    def finalize(self):
+        if path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.temp_path, self.path)
+
+    def iter_columns(self, complete, names):
+        # 指定した列のファイルだけを読み込み、行ごとにその列の値のタプルを返す
+        # 列名は no, user_id, premium, anonymity, deleted, vpos, score, mail, content, date
+        # コマンドとコメント本文を保存していない場合は、空文字列を返す
+        dir = self.path if complete else self.temp_path
+        content = load_json(self._meta_file(dir)).get('content')
+        typecodes = dict(_FIXED_COLUMNS + _CONTENT_COLUMNS)
+        with ExitStack() as stack:
+            def column(name):
+                return stack.enter_context(_map_column(self._column_file(dir, name), typecodes[name]))
+
+            rows = len(column('no'))
+            columns = []
+            for name in names:
+                if name == 'user_id':
+                    users = StringTable(dir, 'user').read()
+                    columns.append(users[i] for i in column('user'))
+                elif name == 'mail' and content:
+                    mails = StringTable(dir, 'mail').read()
+                    columns.append(mails[i] for i in column('mail'))
+                elif name == 'content' and content:
+                    columns.append(StringTable(dir, 'content').read())
+                elif name in ('mail', 'content'):
+                    columns.append(repeat('', rows))
+                else:
+                    columns.append(column(name))
+            for row in zip(*columns):
+                yield row
+
+    def iter_fields(self, complete):
+        dir = self.path if complete else self.temp_path
+        title = load_json(self._meta_file(dir))['title']
+        for user_id, premium, anonymity, deleted in self.iter_columns(
+                complete, ('user_id', 'premium', 'anonymity', 'deleted')):
+            yield title, user_id, premium, anonymity, deleted
+
+    def export_csv(self, file):
+        # 取得済みのコメントを、store = "csv" と同じ形式の CSV ファイルに書き出す
+        meta = load_json(self._meta_file(self.path))
+        with open(file, 'w', encoding=self._r.config.counter.encoding, errors='xmlcharrefreplace') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(COMMENT_CSV_HEADER)
+            writer.writerows((
+                self.video_id,
+                meta['title'],
+                meta['attr'],
+                no,
+                user_id,
+                premium,
+                anonymity,
+                deleted,
+                vpos,
+                score,
+                mail,
+                content,
+                format_date(date),
+            ) for no, user_id, premium, anonymity, deleted, vpos, score, mail, content, date in self.iter_columns(
+                True, ('no', 'user_id', 'premium', 'anonymity', 'deleted', 'vpos', 'score', 'mail', 'content', 'date')))
+
+def open_comment_store(r, video_id):
+    if r.config.counter.store == 'binary':
+        return BinaryCommentStore(r, video_id)
+    return CsvCommentStore(r, video_id)
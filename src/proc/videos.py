@@ -2,7 +2,10 @@
 
 __all__ = ['generate_videos_csv']
 
-import csv, re, json, shutil
+import csv, re, json, shutil, codecs, hashlib
+from os import path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
 from util import *
@@ -10,46 +13,133 @@ from httpclient import (
     represent_default,
     RepresentError,
 )
+from urllib.error import HTTPError
+from .comments import load_videos
 
 logger = getLogger(__name__)
 
-_MYLIST_REGEX = re.compile(r'^\s*Mylist\.preload\([0-9]+, (\[.*\])\);$', re.M)
+_MYLIST_REGEX = re.compile(r'^\s*Mylist\.preload\([0-9]+, \[', re.M)
 
+_SEPARATOR_REGEX = re.compile(r'[\s,]*')
 
-def get_videos(r, mylist_id):
+_JSON_DECODER = json.JSONDecoder()
+
+
+def iter_mylist_items(res, chunk_size=16384):
+    # マイリストページを少しずつ読み込み、Mylist.preload の配列要素を1件ずつ解析する
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ''
+    i = None
+    eof = False
+    while True:
+        if not eof:
+            chunk = res.read(chunk_size)
+            eof = not chunk
+            buffer += decoder.decode(chunk, final=eof)
+        if i is None:
+            m = _MYLIST_REGEX.search(buffer)
+            if m is None:
+                if eof:
+                    raise RepresentError('マイリストデータの解析に失敗しました。')
+                # 行頭の判定に必要な分だけ残して読み進める
+                buffer = buffer[buffer.rfind('\n') + 1:] if '\n' in buffer else buffer
+                continue
+            i = m.end()
+        while True:
+            i = _SEPARATOR_REGEX.match(buffer, i).end()
+            if i < len(buffer) and buffer[i] == ']':
+                return
+            try:
+                item, i = _JSON_DECODER.raw_decode(buffer, i)
+            except ValueError:
+                if eof:
+                    raise RepresentError('マイリストデータの解析に失敗しました。%s' % buffer[i:i + 200])
+                break
+            yield item
+        buffer = buffer[i:]
+        i = 0
+
+
+def get_videos(r, mylist_id, cached=None):
+    # 前回の ETag / Last-Modified があれば条件付きで取得し、変更がなければ前回の動画情報を使用する
     def represent(req, res):
         res = represent_default(req, res)
-        data = res.read().decode()
-        m = _MYLIST_REGEX.search(data)
-        if m is None:
-            raise RepresentError('マイリストデータの解析に失敗しました。')
         try:
-            mylists = json.loads(m.group(1))
-        except:
-            raise RepresentError('マイリストデータの解析に失敗しました。%s' % data)
-        return [(
-            mylist['item_data']['video_id'],
-            mylist['item_data']['title'],
-            mylist['item_data']['view_counter'],
-            mylist['item_data']['num_res'],
-            mylist['item_data']['mylist_counter'],
-            mylist['item_data']['deleted'],
-        ) for mylist in mylists if mylist['item_type'] == 0]
-
-    videos = r.client.request(
+            videos = [(
+                mylist['item_data']['video_id'],
+                mylist['item_data']['title'],
+                mylist['item_data']['view_counter'],
+                mylist['item_data']['num_res'],
+                mylist['item_data']['mylist_counter'],
+                mylist['item_data']['deleted'],
+            ) for mylist in iter_mylist_items(res) if mylist['item_type'] == 0]
+        except (KeyError, TypeError) as err:
+            raise RepresentError('マイリストデータの解析に失敗しました。%s' % err)
+        return {
+            'etag': res.getheader('ETag'),
+            'last_modified': res.getheader('Last-Modified'),
+            'digest': hashlib.sha1(json.dumps(videos, ensure_ascii=False).encode('utf-8')).hexdigest(),
+            'videos': videos,
+        }
+
+    def handle_error(req, err):
+        if isinstance(err, HTTPError) and err.code == 304 and cached:
+            logger.debug('マイリスト %d は更新されていません。', mylist_id)
+            return cached
+        raise err
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    entry = r.client.request(
         r.url.get_mylist_url(mylist_id),
+        headers=headers,
         cookie=False,
         represent_func=represent,
+        handle_error_func=handle_error,
+        endpoint='mylist',
     )
-    if videos is None:
+    if entry is None:
         abort('マイリスト %d の取得に失敗しました。' % mylist_id, logger)
-    logger.debug('マイリスト %d から %d 件の動画情報を取得しました。', mylist_id, len(videos))
-    return videos
+    logger.debug('マイリスト %d から %d 件の動画情報を取得しました。', mylist_id, len(entry['videos']))
+    return entry
+
+
+def get_all_videos(r, state):
+    # マイリストは並列に取得し、設定の順番で結合する (全体の接続間隔は共有される)
+    mylist_ids = r.config.counter.mylist
+    if r.config.http.concurrency < 2 or len(mylist_ids) < 2:
+        entries = [get_videos(r, mylist_id, state.get(str(mylist_id))) for mylist_id in mylist_ids]
+    else:
+        with ThreadPoolExecutor(max_workers=min(r.config.http.concurrency, len(mylist_ids))) as executor:
+            entries = list(executor.map(lambda mylist_id: get_videos(r, mylist_id, state.get(str(mylist_id))),
+                                        mylist_ids))
+    videos = OrderedDict()
+    for mylist_id, entry in zip(mylist_ids, entries):
+        for video in entry['videos']:
+            if video[0] in videos:
+                logger.debug('%s はマイリスト %d と重複しているため除外します。', video[0], mylist_id)
+                continue
+            videos[video[0]] = video
+    return videos, OrderedDict((str(mylist_id), entry) for mylist_id, entry in zip(mylist_ids, entries))
 
 
 def generate_videos_csv(r):
+    # 前回の動画リストから追加された動画の ID を返す
     videos_csv = r.path.videos_csv
     videos_temp_csv = r.path.videos_temp_csv
+    exists = path.isfile(videos_csv)
+    state = (load_json(r.path.mylist_state) or {}) if exists else {}
+    videos, new_state = get_all_videos(r, state)
+    # すべてのマイリストの内容が前回と同じ場合は、動画リストを書き直さない
+    if exists and list(state.keys()) == list(new_state.keys()) and all(
+            state[key].get('digest') == entry['digest'] for key, entry in new_state.items()):
+        dump_json(r.path.mylist_state, new_state)
+        puts('マイリストに変更がないため、動画リスト %s をそのまま使用します。' % videos_csv, logger)
+        return set()
+    old_video_ids = list(load_videos(r).keys()) if exists else None
     with open(videos_temp_csv, 'w', encoding=r.config.counter.encoding, errors='xmlcharrefreplace') as f:
         writer = csv.writer(f, lineterminator='\n')
         writer.writerow((
@@ -60,11 +150,18 @@ def generate_videos_csv(r):
             'マイリスト数',
             '削除フラグ',
         ))
-        for mylist_id in r.config.counter.mylist:
-            videos = get_videos(r, mylist_id)
-            try:
-                writer.writerows(videos)
-            except Exception as err:
-                abort(err, logger)
+        try:
+            writer.writerows(videos.values())
+        except Exception as err:
+            abort(err, logger)
     shutil.move(videos_temp_csv, videos_csv)
+    dump_json(r.path.mylist_state, new_state)
     puts('動画リストを %s に出力しました。' % videos_csv, logger)
+    if old_video_ids is None:
+        return set(videos)
+    old = set(old_video_ids)
+    added = [video_id for video_id in videos if video_id not in old]
+    removed = [video_id for video_id in old_video_ids if video_id not in videos]
+    puts('追加された動画: %d 件 %s' % (len(added), ' '.join(added)), logger)
+    puts('削除された動画: %d 件 %s' % (len(removed), ' '.join(removed)), logger)
+    return set(added)
@@ -6,17 +6,22 @@ __all__ = [
 
 import os
 from os import path
+from threading import Event
 from logging import (
     basicConfig,
+    getLogger,
     FileHandler,
 )
 from datetime import datetime
 
 from filelock import FileLock
 
+from version import __version__
 from util import TZ
 from config import parse_config
 from httpclient import HttpClient
+from metacache import MetadataCache
+from metrics import Metrics
 
 
 class PathInfo:
@@ -28,7 +33,14 @@ class PathInfo:
         self.videos_csv = path.join(dir, 'videos.csv')
         self.videos_temp_csv = path.join(self.temp_dir, '_videos.csv')
         self.result_temp_csv = path.join(self.temp_dir, '_result.csv')
+        self.metadata_cache = path.join(self.temp_dir, 'metadata.json')
+        self.mylist_state = path.join(self.temp_dir, 'mylists.json')
+        self.session = path.join(self.temp_dir, 'session.json')
+        self.metrics_json = path.join(dir, 'metrics.json')
+        self.metrics_prometheus = path.join(dir, 'metrics.prom')
         self.comment_dir = None
+        self.shared_dir = None
+        self.comment_cache_dir = None
 
     def _get_comment_file(self, filename):
         return path.join(self.comment_dir, filename)
@@ -36,47 +48,76 @@ class PathInfo:
     def get_comment_temp_csv(self, video_id):
         return self._get_comment_file('_%s.csv' % video_id)
 
+    def get_comment_state(self, video_id):
+        return self._get_comment_file('_%s.json' % video_id)
+
+    def get_comment_temp_store(self, video_id):
+        return self._get_comment_file('_%s.cols' % video_id)
+
+    def get_comment_store(self, video_id):
+        return self._get_comment_file('%s.cols' % video_id)
+
+    def get_comment_summary(self, video_id):
+        return self._get_comment_file('%s.json' % video_id)
+
     def get_comment_csv(self, video_id):
         return self._get_comment_file('%s.csv' % video_id)
 
+    def get_shared_comments(self, video_id):
+        return path.join(self.shared_dir, '%s.jsonl' % video_id)
+
     def get_result_csv(self, incomplete):
         return path.join(self.work_dir, 'incomplete_result.csv' if incomplete else 'result.csv')
 
+    def get_ranking_csv(self, incomplete):
+        return path.join(self.work_dir, 'incomplete_ranking.csv' if incomplete else 'ranking.csv')
+
+    def get_analytics_csv(self, name, incomplete):
+        return path.join(self.work_dir, ('incomplete_%s.csv' if incomplete else '%s.csv') % name)
+
 
 class UrlInfo:
-    def __init__(self):
-        self.login_url = 'https://secure.nicovideo.jp/secure/login?site=niconico'
-        self.api_json_url = 'http://nmsg.nicovideo.jp/api.json/'
+    def __init__(self, config):
+        self._www = config.www
+        self._flapi = config.flapi
+        self.login_url = '%s/secure/login?site=niconico' % config.secure
+        self.api_json_url = '%s/api.json/' % config.nmsg
+        self.cookie_domain = config.cookie_domain
 
     def get_video_url(self, video_id):
-        return 'http://www.nicovideo.jp/watch/%s' % video_id
+        return '%s/watch/%s' % (self._www, video_id)
 
     def get_waybackkey_url(self, thread_id):
-        return 'http://www.nicovideo.jp/api/getwaybackkey?thread=%s' % thread_id
+        return '%s/api/getwaybackkey?thread=%s' % (self._www, thread_id)
 
     def get_mylist_url(self, mylist_id):
-        return 'http://www.nicovideo.jp/mylist/%d' % mylist_id
+        return '%s/mylist/%d' % (self._www, mylist_id)
 
     def get_flapi_url(self, video_id):
-        return 'http://flapi.nicovideo.jp/api/getflv/%s' % video_id
+        return '%s/api/getflv/%s' % (self._flapi, video_id)
 
 
 class StringInfo:
     def __init__(self):
-        from nicocc import __version__
         self.version = __version__
         self.user_agent = 'python-nicocc/%s' % __version__
 
 
 class Resource:
-    def __init__(self, dir):
+    def __init__(self, dir, shared_dir=None, offline=False):
         dir = dir if path.isabs(dir) else path.join(os.getcwd(), dir)
         self.path = PathInfo(dir)
-        self.url = UrlInfo()
         self.str = StringInfo()
-        self.config = parse_config(self.path.config_file)
+        # 通信しない場合は、ログイン情報がなくてもよい
+        self.config = parse_config(self.path.config_file, ('user',) if offline else ())
+        self.offline = offline
+        self.url = UrlInfo(self.config.url)
+        self.metrics = Metrics()
         self.client = HttpClient(self)
+        self.metadata = MetadataCache(self)
         self.incomplete_cache = datetime.now().timestamp() < self.config.counter.end.timestamp()
+        # 並列取得中に1件でも異常終了した場合は、他の取得もページの区切りで中断する
+        self.stop_event = Event()
 
         comment_dirname = '%s_%s_%s' % (
             self.config.counter.start.strftime('%y%m%d-%H%M%S'),
@@ -87,8 +128,23 @@ class Resource:
 
         if not path.isdir(self.path.comment_dir):
             os.makedirs(self.path.comment_dir)
+        if self.config.cache.comment_dir:
+            self.path.comment_cache_dir = path.join(dir, self.config.cache.comment_dir)
+            os.makedirs(self.path.comment_cache_dir, exist_ok=True)
+        if shared_dir:
+            # 期間の異なる作業フォルダとはコメントを共有しない
+            self.path.shared_dir = path.join(shared_dir, '%s_%s' % (
+                self.config.counter.start.strftime('%y%m%d-%H%M%S'),
+                self.config.counter.end.strftime('%y%m%d-%H%M%S'),
+            ))
+            os.makedirs(self.path.shared_dir, exist_ok=True)
         if not path.isdir(self.path.log_dir):
             os.makedirs(self.path.log_dir)
+        # 同じプロセスで複数の作業フォルダを処理する場合は、前の作業フォルダのログファイルを閉じる
+        root_logger = getLogger()
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+            handler.close()
         basicConfig(
             level=self.config.logging.level,
             format=self.config.logging.format,
@@ -109,4 +165,7 @@ class Resource:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metadata.flush()
+        self.client.close()
+        self.metrics.write(self.path.metrics_json, self.path.metrics_prometheus)
         self._filelock.release()
@@ -3,27 +3,64 @@
 __all__ = [
     'abort',
     'puts',
+    'set_output_prefix',
+    'measure',
     'TZ',
-    'HELP',
+    'load_json',
+    'dump_json',
+    'account_key',
 ]
 
-import sys, pytz
+import sys, os, json, hashlib, pytz
+from time import monotonic
+from contextlib import contextmanager
 
 TZ = pytz.timezone('Asia/Tokyo')
 
+# 並列処理時に、どの作業フォルダの出力かを示す接頭辞
+_output_prefix = ''
+
+def set_output_prefix(prefix):
+    global _output_prefix
+    _output_prefix = '[%s] ' % prefix if prefix else ''
+
 def puts(msg, logger):
     logger.info(msg)
-    print(msg)
+    print('%s%s' % (_output_prefix, msg), flush=bool(_output_prefix))
 
 def abort(msg, logger):
     logger.fatal(msg)
-    print(msg, file=sys.stderr)
+    print('%s%s' % (_output_prefix, msg), file=sys.stderr)
     sys.exit(1)
 
-HELP = '''\
-Usage:
-    nicocc <対象となる nicocc.toml を含むフォルダのパス> ...
-    nicocc --show-config <対象となる nicocc.toml を含むフォルダのパス> ...
-    nicocc --version
-    nicocc --help
-'''
+@contextmanager
+def measure(name, logger, metrics=None):
+    started = monotonic()
+    yield
+    elapsed = monotonic() - started
+    logger.info('処理時間 %s: %.3f 秒', name, elapsed)
+    if metrics is not None:
+        metrics.observe('stage_seconds', elapsed, stage=name)
+
+def load_json(file):
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def dump_json(file, obj, mode=None):
+    temp_file = file + '.tmp'
+    if mode is None:
+        f = open(temp_file, 'w', encoding='utf-8')
+    else:
+        # 作成時からパーミッションを制限し、既存のファイルも同じパーミッションにする
+        f = open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w', encoding='utf-8')
+        os.chmod(temp_file, mode)
+    with f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(temp_file, file)
+
+def account_key(mail):
+    # 保存したデータがどのアカウントのものかを、メールアドレスを残さずに判別する
+    return hashlib.sha256(mail.encode('utf-8')).hexdigest()
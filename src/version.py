@@ -0,0 +1,22 @@
+# coding: utf-8
+
+# バージョンと使い方は、他のモジュールを読み込まずに表示できるようにする
+
+__all__ = [
+    '__version__',
+    'HELP',
+]
+
+__version__ = '0.2.6'
+
+HELP = '''\
+Usage:
+    nicocc <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --jobs <並列数> <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --offline <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --show-config <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --clear-cache <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --export-csv <対象となる nicocc.toml を含むフォルダのパス> ...
+    nicocc --version
+    nicocc --help
+'''
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+# コメントキャッシュの結合が、ファイル全体を読み込んで並べ替えた場合と同じ結果になることを確認する
+#
+#   python -m unittest discover -s tests
+
+import os, sys, io, json, random, shutil, tempfile, unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from proc.cache import merge_comment_files, merge_coverage
+
+
+class MergeCommentFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _write(self, name, nos, source):
+        file = os.path.join(self.dir, name)
+        with open(file, 'w', encoding='utf-8') as f:
+            for no in sorted(nos, reverse=True):
+                f.write(json.dumps({'no': no, 'source': source, 'content': 'コメント'}, ensure_ascii=False) + '\n')
+        return file
+
+    def test_merge(self):
+        rand = random.Random(0)
+        for _ in range(50):
+            old_nos = rand.sample(range(1, 500), rand.randint(0, 200))
+            new_nos = rand.sample(range(1, 500), rand.randint(0, 200))
+            old_file = self._write('old.jsonl', old_nos, 'old')
+            new_file = self._write('new.jsonl', new_nos, 'new')
+            out = io.StringIO()
+            count = merge_comment_files(new_file, old_file, out)
+            comments = [json.loads(line) for line in out.getvalue().splitlines()]
+            nos = sorted(set(old_nos) | set(new_nos), reverse=True)
+            self.assertEqual(count, len(nos))
+            self.assertEqual([comment['no'] for comment in comments], nos)
+            # 同じコメント番号は新しく取得したコメントを残す
+            for comment in comments:
+                self.assertEqual(comment['source'], 'new' if comment['no'] in new_nos else 'old')
+
+    def test_without_cache(self):
+        new_file = self._write('new.jsonl', [3, 2, 1], 'new')
+        out = io.StringIO()
+        self.assertEqual(merge_comment_files(new_file, None, out), 3)
+        with open(new_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(out.getvalue(), f.read())
+
+
+class MergeCoverageTest(unittest.TestCase):
+    def test_merge(self):
+        # meta.json から読み込んだ期間はリストになる
+        self.assertEqual(merge_coverage([[10, 20], [30, 40]] + [[21, 29]]), [[10, 40]])
+        self.assertEqual(merge_coverage([[30, 40]] + [[10, 20]]), [[10, 20], [30, 40]])
+
+
+if __name__ == '__main__':
+    unittest.main()
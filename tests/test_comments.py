@@ -0,0 +1,59 @@
+# coding: utf-8
+
+# 視聴ページから data-api-data 属性を読み込んだ後、残りが小さい場合だけ読み切ることを確認する
+#
+#   python -m unittest discover -s tests
+
+import os, sys, io, unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from proc.comments import read_api_data, _DRAIN_LIMIT
+
+
+class FakeResponse:
+    # Content-Length がある場合は remaining に未受信のバイト数を返す
+    def __init__(self, body, content_length=True):
+        self._body = io.BytesIO(body)
+        self._size = len(body)
+        self._content_length = content_length
+
+    @property
+    def remaining(self):
+        return self._size - self._body.tell() if self._content_length else None
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+
+def make_page(head, tail):
+    return (b'<html><body>' + b'<p>head</p>' * head +
+            b'<div id="js-initial-watch-data" data-api-data="{&quot;a&quot;: 1}" data-environment="{}"></div>' +
+            b'<p>tail</p>' * tail + b'</body></html>')
+
+
+class ReadApiDataTest(unittest.TestCase):
+    def test_drain_small_rest(self):
+        res = FakeResponse(make_page(100, 100))
+        self.assertEqual(read_api_data(res, 256), ('{"a": 1}', None))
+        self.assertEqual(res.remaining, 0)
+
+    def test_keep_large_rest(self):
+        tail = _DRAIN_LIMIT // len(b'<p>tail</p>') + 100
+        res = FakeResponse(make_page(100, tail))
+        self.assertEqual(read_api_data(res, 256), ('{"a": 1}', None))
+        self.assertGreater(res.remaining, _DRAIN_LIMIT)
+
+    def test_keep_unknown_rest(self):
+        res = FakeResponse(make_page(100, 100), content_length=False)
+        self.assertEqual(read_api_data(res, 256), ('{"a": 1}', None))
+        self.assertNotEqual(res.read(), b'')
+
+    def test_without_api_data(self):
+        page = b'<html><body>' + b'<p>page</p>' * 100 + b'</body></html>'
+        self.assertEqual(read_api_data(FakeResponse(page), 256), (None, page))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+# 自動調整時に、失敗が続くと待機時間が server_error_interval から max_backoff まで倍々に延びることを確認する
+#
+#   python -m unittest discover -s tests
+
+import os, sys, unittest
+from types import SimpleNamespace
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from httpclient import AdaptivePacer
+
+
+class FakeBucket:
+    def __init__(self):
+        self.delays = []
+
+    def delay(self, seconds):
+        self.delays.append(seconds)
+
+    def set_interval(self, interval):
+        pass
+
+
+def make_config(adaptive):
+    # サンプルの設定値 (秒)
+    return SimpleNamespace(
+        adaptive=adaptive,
+        interval=1,
+        server_error_interval=30,
+        min_interval=0.2,
+        max_interval=10,
+        slow_response=2,
+        max_backoff=300,
+    )
+
+
+class AdaptivePacerTest(unittest.TestCase):
+    def test_backoff_doubles(self):
+        for _ in range(20):
+            bucket = FakeBucket()
+            pacer = AdaptivePacer(bucket, make_config(True))
+            for _ in range(8):
+                pacer.failure()
+            for i, delay in enumerate(bucket.delays):
+                backoff = min(300, 30 * 2 ** i)
+                self.assertGreaterEqual(delay, max(30, backoff / 2))
+                self.assertLessEqual(delay, backoff)
+
+    def test_success_resets_backoff(self):
+        bucket = FakeBucket()
+        pacer = AdaptivePacer(bucket, make_config(True))
+        for _ in range(4):
+            pacer.failure()
+        pacer.success(0.1)
+        pacer.failure()
+        self.assertEqual(bucket.delays[-1], 30)
+
+    def test_fixed_interval(self):
+        # 固定間隔の場合は、サーバーエラーでは server_error_interval だけ待機し、タイムアウトでは待機しない
+        bucket = FakeBucket()
+        pacer = AdaptivePacer(bucket, make_config(False))
+        pacer.failure()
+        pacer.failure()
+        pacer.failure(timed_out=True)
+        self.assertEqual(bucket.delays, [30, 30])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+# coding: utf-8
+
+# コメントファイルの書き込み結果が、1行ずつ strftime と writerow で書き込んでいた頃と
+# バイト単位で一致することを確認する
+#
+#   python -m unittest discover -s tests
+#
+# data/comments_page.csv は、従来の書き込み方法で作成したコメントファイル
+
+import os, sys, csv, shutil, tempfile, unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+from util import TZ
+from proc.store import COMMENT_CSV_HEADER, CsvCommentStore, BinaryCommentStore, StringTable, DateFormatter
+
+GOLDEN_CSV = os.path.join(TESTS_DIR, 'data', 'comments_page.csv')
+
+VIDEO_ID = 'sm100'
+TITLE = '動画タイトル ① 😀'
+ATTR = 'attr'
+
+# 時差が変わる日時 (UTC)
+_LMT_END = -2 ** 31          # 1901-12-13 20:45:52 (15分の途中で LMT から JST に変わる)
+_JDT_START = -683802000      # 1948-05-01 15:00:00 (JST から JDT)
+_JDT_END = -640861200        # 1949-09-10 15:00:00 (JDT から JST)
+_JST_MIDNIGHT = 1518188400   # 2018-02-09 15:00:00 (現地時刻の日付が変わる)
+
+
+def _dates():
+    for boundary in (_LMT_END, _JDT_START, _JDT_END, _JST_MIDNIGHT):
+        for delta in (-3601, -3600, -901, -900, -1, 0, 1, 899, 900, 3599, 3600):
+            yield boundary + delta
+
+
+def _contents():
+    # cp932 にない文字は xmlcharrefreplace で文字参照になる
+    return (
+        'こんにちは',
+        '①～㈱',
+        'café 😀 𠮷野家',
+        'カンマ, と "引用符"',
+        '改行\nを含む',
+        '',
+    )
+
+
+def make_pages():
+    contents = _contents()
+    comments = []
+    for i, date in enumerate(_dates()):
+        comment = {
+            'no': i + 1,
+            'vpos': i * 100 - 50,
+            'date': date,
+            'content': contents[i % len(contents)],
+        }
+        if i % 3:
+            comment['user_id'] = 'user%d' % (i % 7) if i % 2 else 'ユーザー😀'
+            comment['mail'] = '184 red' if i % 4 else 'naka ♡'
+            comment['premium'] = i % 2
+            comment['anonymity'] = (i // 2) % 2
+            comment['score'] = -i
+        if i % 11 == 0:
+            comment['deleted'] = 1
+        comments.append(comment)
+    # 複数のページに分けて書き込む
+    return comments[:20], comments[20:]
+
+
+def write_legacy(file, pages, encoding='cp932'):
+    with open(file, 'w', encoding=encoding, errors='xmlcharrefreplace') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(COMMENT_CSV_HEADER)
+        for comments in pages:
+            for comment in comments:
+                writer.writerow((
+                    VIDEO_ID,
+                    TITLE,
+                    ATTR,
+                    comment['no'],
+                    comment.get('user_id', ''),
+                    comment.get('premium', 0),
+                    comment.get('anonymity', 0),
+                    comment.get('deleted', 0),
+                    comment['vpos'],
+                    comment.get('score', 0),
+                    comment.get('mail', ''),
+                    comment.get('content', ''),
+                    datetime.fromtimestamp(comment['date'], tz=TZ).strftime('%Y-%m-%d %H:%M:%S'),
+                ))
+
+
+def read_bytes(file):
+    with open(file, 'rb') as f:
+        return f.read()
+
+
+class CsvCommentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _resource(self, encoding):
+        return SimpleNamespace(
+            config=SimpleNamespace(counter=SimpleNamespace(encoding=encoding)),
+            path=SimpleNamespace(
+                get_comment_temp_csv=lambda video_id: os.path.join(self.dir, '_%s.csv' % video_id),
+                get_comment_csv=lambda video_id: os.path.join(self.dir, '%s.csv' % video_id),
+            ),
+        )
+
+    def _write_store(self, pages, encoding='cp932'):
+        store = CsvCommentStore(self._resource(encoding), VIDEO_ID)
+        store.open(False)
+        try:
+            for comments in pages:
+                store.write(TITLE, ATTR, comments)
+        finally:
+            store.close()
+        store.finalize()
+        return read_bytes(store.path)
+
+    def test_golden(self):
+        self.assertEqual(self._write_store(make_pages()), read_bytes(GOLDEN_CSV))
+
+    def test_legacy(self):
+        for encoding in ('cp932', 'utf-8'):
+            legacy_csv = os.path.join(self.dir, 'legacy.csv')
+            write_legacy(legacy_csv, make_pages(), encoding)
+            self.assertEqual(self._write_store(make_pages(), encoding), read_bytes(legacy_csv), encoding)
+
+    def test_restore(self):
+        first, second = make_pages()
+        store = CsvCommentStore(self._resource('cp932'), VIDEO_ID)
+        store.open(False)
+        store.write(TITLE, ATTR, first)
+        position = store.position()
+        store.write(TITLE, ATTR, second[:5])
+        store.close()
+        self.assertTrue(store.restore(position))
+        store.open(True)
+        store.write(TITLE, ATTR, second)
+        store.close()
+        store.finalize()
+        self.assertEqual(read_bytes(store.path), read_bytes(GOLDEN_CSV))
+
+    def test_character_references(self):
+        data = read_bytes(GOLDEN_CSV)
+        for ref in (b'&#233;', b'&#128512;', b'&#134071;', b'&#9825;'):
+            self.assertIn(ref, data)
+
+
+class BinaryCommentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _store(self, content=True):
+        r = SimpleNamespace(
+            config=SimpleNamespace(counter=SimpleNamespace(encoding='cp932', store_content=content)),
+            path=SimpleNamespace(
+                get_comment_temp_store=lambda video_id: os.path.join(self.dir, '_%s.cols' % video_id),
+                get_comment_store=lambda video_id: os.path.join(self.dir, '%s.cols' % video_id),
+            ),
+        )
+        return BinaryCommentStore(r, VIDEO_ID)
+
+    def _rows(self, names, comments):
+        rows = []
+        for comment in comments:
+            values = dict(comment, user_id=comment.get('user_id', ''))
+            rows.append(tuple(values.get(name, 0 if name in ('premium', 'anonymity', 'deleted', 'score') else '')
+                              for name in names))
+        return rows
+
+    def test_restore(self):
+        # 確定した位置まで切り詰めて再開し、未確定のページの行や文字列が残らないことを確認する
+        first, second = make_pages()
+        discarded = [dict(comment, user_id='discarded', mail='discarded', content='discarded')
+                     for comment in second[:5]]
+        store = self._store()
+        store.open(False)
+        store.write(TITLE, ATTR, first[:10])
+        position = store.position()
+        store.write(TITLE, ATTR, discarded)
+        store.position()
+        store.close()
+
+        store = self._store()
+        self.assertTrue(store.restore(position))
+        store.open(True)
+        store.write(TITLE, ATTR, first[10:])
+        store.write(TITLE, ATTR, second)
+        store.position()
+        store.close()
+        store.finalize()
+
+        names = ('no', 'user_id', 'premium', 'anonymity', 'deleted', 'vpos', 'score', 'mail', 'content', 'date')
+        comments = first + second
+        self.assertEqual(list(store.iter_columns(True, names)), self._rows(names, comments))
+        fields = self._rows(('user_id', 'premium', 'anonymity', 'deleted'), comments)
+        self.assertEqual(list(store.iter_fields(True)), [(TITLE,) + row for row in fields])
+        for name in ('user', 'mail'):
+            self.assertNotIn('discarded', StringTable(store.path, name).read())
+
+    def test_restore_invalid_position(self):
+        store = self._store()
+        store.open(False)
+        store.write(TITLE, ATTR, make_pages()[0])
+        position = store.position()
+        store.close()
+        self.assertFalse(store.restore(dict(position, rows=position['rows'] + 1)))
+        self.assertFalse(store.restore(None))
+
+    def test_export_csv(self):
+        # CSV ファイルに書き出した結果が、store = "csv" で保存した場合と一致することを確認する
+        store = self._store()
+        store.open(False)
+        for comments in make_pages():
+            store.write(TITLE, ATTR, comments)
+        store.position()
+        store.close()
+        store.finalize()
+        exported_csv = os.path.join(self.dir, 'exported.csv')
+        store.export_csv(exported_csv)
+        self.assertEqual(read_bytes(exported_csv), read_bytes(GOLDEN_CSV))
+
+    def test_without_content(self):
+        store = self._store(False)
+        store.open(False)
+        for comments in make_pages():
+            store.write(TITLE, ATTR, comments)
+        store.position()
+        store.close()
+        store.finalize()
+        for no, mail, content in store.iter_columns(True, ('no', 'mail', 'content')):
+            self.assertEqual((mail, content), ('', ''))
+
+
+class DateFormatterTest(unittest.TestCase):
+    def test_offset_boundaries(self):
+        # 15分単位のキャッシュが境界の前後で混ざらないよう、境界をまたいで昇順と降順の両方で変換する
+        for dates in (sorted(_dates()), sorted(_dates(), reverse=True)):
+            format_date = DateFormatter()
+            for date in dates:
+                expected = datetime.fromtimestamp(date, tz=TZ).strftime('%Y-%m-%d %H:%M:%S')
+                self.assertEqual(format_date(date), expected, date)
+
+    def test_every_second_around_lmt_end(self):
+        format_date = DateFormatter()
+        for date in range(_LMT_END - 1800, _LMT_END + 1800):
+            expected = datetime.fromtimestamp(date, tz=TZ).strftime('%Y-%m-%d %H:%M:%S')
+            self.assertEqual(format_date(date), expected, date)
+
+
+if __name__ == '__main__':
+    unittest.main()